@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the parts of the EasyPost API used by django-easypost, for benchmarking without the network
+
+Every request can be delayed by a fixed latency and a fraction of requests can be failed with a 500 or 429.
+"""
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+
+class FakeEasyPostServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, rate_limit_rate=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeEasyPostHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.shipments = {}
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/v2'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def new_id(self, prefix):
+        with self._lock:
+            return '{0}_{1:024d}'.format(prefix, next(self._ids))
+
+    def add_shipment(self, easypost_id=None, bought=False, refund_status=None):
+        """
+        Add a shipment to the server, e.g. for shipments created directly in the database
+        """
+        easypost_id = easypost_id or self.new_id('shp')
+        shipment = {
+            'object': 'Shipment',
+            'id': easypost_id,
+            'mode': 'test',
+            'tracking_code': None,
+            'refund_status': refund_status,
+            'postage_label': None,
+            'rates': [self.rate(easypost_id, carrier, service, price)
+                      for carrier, service, price in [('USPS', 'First', '2.95'), ('USPS', 'Priority', '6.10'),
+                                                      ('UPS', 'Ground', '8.47'), ('FedEx', 'FEDEX_GROUND', '9.12')]],
+        }
+        self.shipments[easypost_id] = shipment
+        if bought:
+            self.buy(shipment)
+        return shipment
+
+    def rate(self, shipment_id, carrier, service, price):
+        return {'object': 'Rate', 'id': self.new_id('rate'), 'shipment_id': shipment_id, 'carrier': carrier,
+                'service': service, 'rate': price, 'currency': 'USD', 'delivery_days': 2}
+
+    def buy(self, shipment):
+        shipment['tracking_code'] = '94{0:020d}'.format(random.randint(0, 10 ** 18))
+        shipment['postage_label'] = {'object': 'PostageLabel', 'id': self.new_id('pl'),
+                                     'label_url': 'http://127.0.0.1/labels/{0}.png'.format(shipment['id'])}
+        return shipment
+
+
+class FakeEasyPostHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('POST', r'^/v2/addresses$', 'create_address'),
+        ('GET', r'^/v2/addresses/(?P<id>[^/]+)/verify$', 'verify_address'),
+        ('POST', r'^/v2/parcels$', 'create_parcel'),
+        ('POST', r'^/v2/shipments$', 'create_shipment'),
+        ('GET', r'^/v2/shipments/(?P<id>[^/]+)$', 'retrieve_shipment'),
+        ('GET', r'^/v2/shipments/(?P<id>[^/]+)/rates$', 'retrieve_shipment'),
+        ('POST', r'^/v2/shipments/(?P<id>[^/]+)/buy$', 'buy_shipment'),
+        ('GET', r'^/v2/shipments/(?P<id>[^/]+)/refund$', 'refund_shipment'),
+        ('GET', r'^/v2/shipments/(?P<id>[^/]+)/label$', 'label_shipment'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        with self.server._lock:
+            self.server.requests += 1
+
+        path, _, query = self.path.partition('?')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        roll = random.random()
+        if roll < self.server.rate_limit_rate:
+            return self.respond(429, {'error': {'code': 'RATE_LIMITED', 'message': 'Too many requests'}})
+        if roll < self.server.rate_limit_rate + self.server.error_rate:
+            return self.respond(500, {'error': {'code': 'INTERNAL_SERVER_ERROR', 'message': 'Injected error'}})
+
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                status, body = getattr(self, handler)(query=query, **match.groupdict())
+                return self.respond(status, body)
+
+        self.respond(404, {'error': {'code': 'NOT_FOUND', 'message': 'Not found'}})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_shipment(self, id):
+        shipment = self.server.shipments.get(id)
+        if shipment is None:
+            shipment = self.server.add_shipment(id)
+        return shipment
+
+    def create_address(self, query):
+        return 201, {'object': 'Address', 'id': self.server.new_id('adr')}
+
+    def verify_address(self, id, query):
+        return 200, {'address': {'object': 'Address', 'id': id, 'street1': '98 SAN JACINTO BLVD', 'street2': '',
+                                 'city': 'AUSTIN', 'state': 'TX', 'zip': '78701-4082', 'country': 'US'}}
+
+    def create_parcel(self, query):
+        return 201, {'object': 'Parcel', 'id': self.server.new_id('prcl'), 'weight': 10.0}
+
+    def create_shipment(self, query):
+        return 201, self.server.add_shipment()
+
+    def retrieve_shipment(self, id, query):
+        return 200, self.get_shipment(id)
+
+    def buy_shipment(self, id, query):
+        return 200, self.server.buy(self.get_shipment(id))
+
+    def refund_shipment(self, id, query):
+        shipment = self.get_shipment(id)
+        shipment['refund_status'] = 'submitted'
+        return 200, shipment
+
+    def label_shipment(self, id, query):
+        shipment = self.get_shipment(id)
+        if not shipment['postage_label']:
+            return 422, {'error': {'code': 'SHIPMENT.POSTAGE.REQUIRED', 'message': 'No label has been bought'}}
+
+        format = re.search(r'file_format=(\w+)', query)
+        if format and format.group(1) != 'png':
+            url = 'http://127.0.0.1/labels/{0}.{1}'.format(id, format.group(1))
+            shipment['postage_label']['label_{0}_url'.format(format.group(1))] = url
+        return 200, shipment
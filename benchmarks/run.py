@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for django-easypost, run against benchmarks.fake_easypost instead of the EasyPost API
+
+    python -m benchmarks.run --latency 0.05 --output results.json
+
+Results are written as JSON so that runs for different versions can be compared.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import django
+
+
+def percentile(durations, fraction):
+    durations = sorted(durations)
+    return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+
+
+def summarize(durations):
+    if not durations:
+        return {'count': 0}
+    return {
+        'count': len(durations),
+        'total': sum(durations),
+        'mean': sum(durations) / len(durations),
+        'p50': percentile(durations, 0.5),
+        'p95': percentile(durations, 0.95),
+        'max': max(durations),
+    }
+
+
+def create_shipments(count, **kwargs):
+    from easypost.models import Address, Shipment
+
+    to_address = Address.objects.create(ship='Four Seasons Hotel Austin', street1='98 San Jacinto Blvd',
+                                        city='Austin', state='TX', zip_code='78701', country='US')
+    from_address = Address.objects.create(ship='Company Deluxe', street1='9321 Pocahontas Trail',
+                                          city='Providence Forge', state='VA', zip_code='23140', country='US')
+    Shipment.objects.bulk_create([Shipment(to_address=to_address, from_address=from_address, **kwargs)
+                                  for i in range(count)])
+    return Shipment.objects.filter(to_address=to_address).order_by('id')
+
+
+def bench_webhook_ingestion(server, events, history_length):
+    """
+    process_webhook_event for tracker.updated events, each carrying the shipment's full tracking history
+    """
+    from easypost.tasks import process_webhook_event
+
+    shipments = list(create_shipments(max(1, events // 10)))
+    for index, shipment in enumerate(shipments):
+        shipment.easypost_id = server.add_shipment(bought=True)['id']
+        shipment.save(update_fields=['easypost_id'])
+
+    payloads = []
+    for index in range(events):
+        shipment = shipments[index % len(shipments)]
+        details = [{'object': 'TrackingDetail', 'status': 'in_transit', 'message': 'Scan {0}'.format(detail),
+                    'datetime': '2015-10-{0:02d}T{1:02d}:00:00Z'.format(1 + detail // 24, detail % 24)}
+                   for detail in range(min(history_length, index // len(shipments) + 1))]
+        payloads.append(json.dumps({
+            'id': 'evt_{0:024d}'.format(index),
+            'object': 'Event',
+            'description': 'tracker.updated',
+            'result': {'object': 'Tracker', 'id': 'trk_{0}'.format(shipment.id), 'status': 'in_transit',
+                       'tracking_code': '9499907123456123456781', 'shipment_id': shipment.easypost_id,
+                       'tracking_details': details}
+        }))
+
+    start = time.time()
+    for payload in payloads:
+        process_webhook_event(payload)
+    duration = time.time() - start
+    return {'events': events, 'history_length': history_length, 'seconds': duration, 'events_per_second': events / duration}
+
+
+def bench_buy_label(server, buys):
+    """
+    Creating a shipment on EasyPost and buying its label, end to end
+
+    Buys which fail, e.g. on errors injected by the fake server, are counted and left out of the durations.
+    """
+    durations = []
+    errors = {}
+    for shipment in create_shipments(buys):
+        start = time.time()
+        try:
+            shipment.create_on_easypost({'weight': 10.0})
+            shipment.buy_label()
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        durations.append(time.time() - start)
+    result = summarize(durations)
+    result['errors'] = errors
+    return result
+
+
+def bench_update_refund_statuses(server, shipments):
+    """
+    update_refund_statuses over shipments which all have a submitted refund
+    """
+    from easypost.models import Shipment
+    from easypost.tasks import update_refund_statuses
+
+    for shipment in create_shipments(shipments, refund_status=Shipment.RefundStatus.SUBMITTED):
+        shipment.easypost_id = server.add_shipment(bought=True, refund_status='refunded')['id']
+        shipment.save(update_fields=['easypost_id'])
+
+    start = time.time()
+    counts = update_refund_statuses()
+    duration = time.time() - start
+    return {'shipments': shipments, 'seconds': duration, 'shipments_per_second': shipments / duration,
+            'counts': counts}
+
+
+def bench_label_formats(server, labels):
+    """
+    get_additional_label_formats for bought labels
+    """
+    from easypost.models import Label
+    from easypost.tasks import get_additional_label_formats
+
+    label_ids = []
+    for shipment in create_shipments(labels):
+        shipment.easypost_id = server.add_shipment(bought=True)['id']
+        shipment.save(update_fields=['easypost_id'])
+        label_ids.append(Label.objects.create(shipment=shipment, easypost_id=shipment.easypost_id).id)
+
+    durations = []
+    for label_id in label_ids:
+        start = time.time()
+        get_additional_label_formats(label_id)
+        durations.append(time.time() - start)
+    return summarize(durations)
+
+
+BENCHMARKS = ['webhook_ingestion', 'buy_label', 'update_refund_statuses', 'label_formats']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, any of {0} (default: all)'.format(
+        ', '.join(BENCHMARKS)))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake API response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failed with a 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests failed with a 429')
+    parser.add_argument('--webhook-events', type=int, default=1000)
+    parser.add_argument('--history-length', type=int, default=30)
+    parser.add_argument('--buys', type=int, default=50)
+    parser.add_argument('--refunds', type=int, default=10000)
+    parser.add_argument('--labels', type=int, default=20)
+    parser.add_argument('--label', default='', help='a name for this run, e.g. the version being measured')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {0}'.format(name))
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'easypost.test_settings')
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    import easypost
+    from .fake_easypost import FakeEasyPostServer
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+    server = FakeEasyPostServer(latency=args.latency, error_rate=args.error_rate,
+                                rate_limit_rate=args.rate_limit_rate).start()
+    easypost.api_base = server.url
+
+    arguments = {
+        'webhook_ingestion': (args.webhook_events, args.history_length),
+        'buy_label': (args.buys, ),
+        'update_refund_statuses': (args.refunds, ),
+        'label_formats': (args.labels, ),
+    }
+    results = {
+        'label': args.label,
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'settings': dict((name, value) for name, value in vars(args).items() if name not in ('benchmarks', 'output')),
+        'benchmarks': {},
+    }
+    try:
+        for name in args.benchmarks or BENCHMARKS:
+            requests_before = server.requests
+            result = globals()['bench_{0}'.format(name)](server, *arguments[name])
+            result['api_requests'] = server.requests - requests_before
+            results['benchmarks'][name] = result
+    finally:
+        server.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
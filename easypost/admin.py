@@ -1,11 +1,114 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
-from .models import Address, Shipment, ShipmentItem, Parcel, ShipmentTrackingHistory
+from .models import Address, AddressVerification, Shipment, ShipmentRate, ShipmentItem, Label, Parcel, ParcelSignature, ShipmentTrackingHistory, WebhookEvent
 
 
-admin.site.register(Address)
-admin.site.register(Shipment)
-admin.site.register(ShipmentItem)
-admin.site.register(Parcel)
-admin.site.register(ShipmentTrackingHistory)
+class EstimatedCountPaginator(Paginator):
+    """
+    A Paginator which, for an unfiltered changelist of a large table on PostgreSQL, uses the number of rows
+    PostgreSQL estimates for the table rather than counting all of them
+    """
+    # tables estimated to be smaller than this are still counted exactly
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                                   [self.object_list.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] >= self.estimate_threshold:
+                    return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    A ModelAdmin for tables which grow with the number of shipments, which never counts all of the rows
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class AddressAdmin(LargeTableAdmin):
+    list_display = ('ship', 'street1', 'city', 'state', 'zip_code', 'country', 'verified_address')
+    search_fields = ('=easypost_id',)
+
+
+class AddressVerificationAdmin(LargeTableAdmin):
+    list_display = ('fingerprint', 'street1', 'city', 'state', 'zip_code', 'country', 'verified_date')
+    search_fields = ('=fingerprint',)
+
+
+class ShipmentAdmin(LargeTableAdmin):
+    list_display = ('easypost_id', 'tracking_code', 'to_address', 'carrier', 'service', 'tracking_status',
+                    'refund_status', 'created_date')
+    list_filter = ('carrier', 'tracking_status', 'refund_status')
+    list_select_related = ('to_address',)
+    search_fields = ('=easypost_id', '=tracking_code')
+    raw_id_fields = ('to_address', 'from_address', 'created_by')
+
+
+class ShipmentRateAdmin(LargeTableAdmin):
+    list_display = ('shipment', 'carrier', 'service', 'rate', 'delivery_days', 'created_date')
+    list_select_related = ('shipment',)
+    search_fields = ('=easypost_id', '=shipment__easypost_id')
+    raw_id_fields = ('shipment',)
+
+
+class ShipmentItemAdmin(LargeTableAdmin):
+    list_display = ('shipment', 'count')
+    list_select_related = ('shipment',)
+    search_fields = ('=shipment__easypost_id',)
+    raw_id_fields = ('shipment',)
+
+
+class LabelAdmin(LargeTableAdmin):
+    list_display = ('shipment', 'created_date')
+    list_select_related = ('shipment',)
+    search_fields = ('=shipment__easypost_id', '=shipment__tracking_code')
+    raw_id_fields = ('shipment', 'created_by')
+
+
+class ParcelAdmin(LargeTableAdmin):
+    list_display = ('shipment', 'weight', 'predefined_package', 'created_date')
+    list_select_related = ('shipment',)
+    search_fields = ('=shipment__easypost_id',)
+    raw_id_fields = ('shipment', 'created_by')
+
+
+class ParcelSignatureAdmin(LargeTableAdmin):
+    list_display = ('signature', 'easypost_id', 'created_date')
+    search_fields = ('=signature',)
+
+
+class ShipmentTrackingHistoryAdmin(LargeTableAdmin):
+    list_display = ('shipment', 'status', 'message', 'update_time')
+    list_select_related = ('shipment',)
+    search_fields = ('=shipment__easypost_id', '=shipment__tracking_code')
+    raw_id_fields = ('shipment', 'created_by')
+
+
+class WebhookEventAdmin(LargeTableAdmin):
+    list_display = ('easypost_id', 'created_date')
+    search_fields = ('=easypost_id',)
+
+
+admin.site.register(Address, AddressAdmin)
+admin.site.register(AddressVerification, AddressVerificationAdmin)
+admin.site.register(Shipment, ShipmentAdmin)
+admin.site.register(ShipmentRate, ShipmentRateAdmin)
+admin.site.register(ShipmentItem, ShipmentItemAdmin)
+admin.site.register(Label, LabelAdmin)
+admin.site.register(Parcel, ParcelAdmin)
+admin.site.register(ParcelSignature, ParcelSignatureAdmin)
+admin.site.register(ShipmentTrackingHistory, ShipmentTrackingHistoryAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
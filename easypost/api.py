@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.utils import six
+
+import sys
+import time
+
+from .ratelimit import rate_limiter, is_rate_limited
+from .signals import api_call_finished
+from .transport import get_session
+
+
+def call_api(operation, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), which makes a request to the EasyPost API, and send
+    :data:`easypost.signals.api_call_finished` with how long it took and the exception it raised, if any
+
+    Every EasyPost call made by this app goes through here, e.g.::
+
+        shipment = call_api('shipment.retrieve', easypost.Shipment.retrieve, easypost_id)
+
+    Calls wait for the rate limiter first, see :class:`easypost.ratelimit.RateLimiter`, and a call which is
+    rate limited by EasyPost is retried up to EASYPOST_RATE_LIMIT_RETRIES times after backing off.
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire(operation)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            api_call_finished.send(sender=None, operation=operation, duration=time.time() - start, error=e)
+            if is_rate_limited(e) and attempt < rate_limiter.retries:
+                rate_limiter.backoff(operation, attempt, get_session().pop_retry_after())
+                attempt += 1
+                continue
+            six.reraise(*exc_info)
+
+        api_call_finished.send(sender=None, operation=operation, duration=time.time() - start, error=None)
+        return result
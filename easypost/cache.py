@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_started, request_finished
+from django.utils.module_loading import import_string
+
+from celery.signals import task_prerun, task_postrun
+
+import threading
+
+import easypost
+
+
+class ShipmentCache(object):
+    """
+    Caches easypost.Shipment objects by their EasyPost id
+
+    Shipments are always memoized for the current request or task. If EASYPOST_SHIPMENT_CACHE_TIMEOUT is set
+    they are also stored in the Django cache named by EASYPOST_CACHE for that many seconds so they can be
+    shared between requests and workers.
+    """
+    key_prefix = 'easypost:shipment:'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'EASYPOST_SHIPMENT_CACHE_TIMEOUT', None)
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'EASYPOST_CACHE', 'default')]
+
+    @property
+    def shipments(self):
+        if not hasattr(self._local, 'shipments'):
+            self._local.shipments = {}
+        return self._local.shipments
+
+    def get(self, easypost_id):
+        shipment = self.shipments.get(easypost_id)
+        if shipment is None and self.timeout:
+            values = self.cache.get(self.key_prefix + easypost_id)
+            if values is not None:
+                shipment = easypost.convert_to_easypost_object(values, settings.EASYPOST_API_KEY)
+                self.shipments[easypost_id] = shipment
+        return shipment
+
+    def set(self, shipment):
+        self.shipments[shipment.id] = shipment
+        if self.timeout:
+            self.cache.set(self.key_prefix + shipment.id, shipment.to_dict(), self.timeout)
+
+    def delete(self, easypost_id):
+        """
+        Forget a shipment, should be called after anything which changes it on EasyPost
+        """
+        self.shipments.pop(easypost_id, None)
+        if self.timeout:
+            self.cache.delete(self.key_prefix + easypost_id)
+
+    def clear(self):
+        """
+        Forget the shipments memoized for the current request or task
+        """
+        self.shipments.clear()
+
+
+shipment_cache = import_string(getattr(settings, 'EASYPOST_SHIPMENT_CACHE', 'easypost.cache.ShipmentCache'))()
+
+
+def clear_shipment_cache(**kwargs):
+    shipment_cache.clear()
+
+
+request_started.connect(clear_shipment_cache, dispatch_uid='easypost_request_started_shipment_cache')
+request_finished.connect(clear_shipment_cache, dispatch_uid='easypost_request_finished_shipment_cache')
+task_prerun.connect(clear_shipment_cache, dispatch_uid='easypost_task_prerun_shipment_cache')
+task_postrun.connect(clear_shipment_cache, dispatch_uid='easypost_task_postrun_shipment_cache')
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from easypost.models import ShipmentTrackingHistory
+
+
+class Command(BaseCommand):
+    help = "Set the tracking_key of tracking histories stored before it was added, deleting duplicate histories"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="how many histories to update at a time (default: 1000)")
+
+    def handle(self, *args, **options):
+        updated, deleted = ShipmentTrackingHistory.objects.backfill_tracking_keys(options['batch_size'])
+        self.stdout.write("Updated {0} tracking histories, deleted {1} duplicates".format(updated, deleted))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+import sys
+
+from easypost.models import Label
+from easypost.printing import write_print_file
+
+
+class Command(BaseCommand):
+    help = "Write one ZPL, EPL2 or PDF print file for a batch of labels"
+
+    def add_arguments(self, parser):
+        parser.add_argument('label_ids', nargs='*', type=int, help="ids of the labels, in printing order")
+        parser.add_argument('--shipments', nargs='*', type=int, default=[],
+                            help="ids of shipments whose labels are also printed")
+        parser.add_argument('--format', default=Label.LabelFormats.ZPL,
+                            choices=[Label.LabelFormats.ZPL, Label.LabelFormats.EPL2, Label.LabelFormats.PDF])
+        parser.add_argument('--output', default='-', help="file to write to, - for stdout (default)")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="how many label files to fetch at the same time (default: EASYPOST_PRINT_WORKERS)")
+
+    def handle(self, *args, **options):
+        labels = Label.objects.in_bulk(options['label_ids'])
+        missing = [str(label_id) for label_id in options['label_ids'] if label_id not in labels]
+        if missing:
+            raise CommandError("Unknown labels: {0}".format(', '.join(missing)))
+
+        ordered = [labels[label_id] for label_id in options['label_ids']]
+        if options['shipments']:
+            ordered.extend(Label.objects.filter(shipment_id__in=options['shipments']).order_by('shipment_id'))
+        if not ordered:
+            raise CommandError("No labels to print")
+
+        if options['output'] == '-':
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+            write_print_file(ordered, output, options['format'], options['workers'])
+            output.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                write_print_file(ordered, output, options['format'], options['workers'])
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from collections import defaultdict
+import bisect
+import threading
+
+from .signals import api_call_finished
+
+
+class ApiMetrics(object):
+    """
+    In-process call counts, error counts by exception type and latency histograms for each EasyPost operation
+
+    Fed by :data:`easypost.signals.api_call_finished`, read with snapshot()
+    """
+    # upper bounds, in seconds, of the latency histogram buckets. Anything slower is counted in a final bucket.
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = defaultdict(int)
+            self.errors = defaultdict(lambda: defaultdict(int))
+            self.latencies = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+            self.total_duration = defaultdict(float)
+
+    def record(self, sender, operation, duration, error, **kwargs):
+        with self._lock:
+            self.calls[operation] += 1
+            self.total_duration[operation] += duration
+            self.latencies[operation][bisect.bisect_left(self.buckets, duration)] += 1
+            if error is not None:
+                self.errors[operation][type(error).__name__] += 1
+
+    def snapshot(self):
+        """
+        Returns a dict of operation to its calls, errors (by exception type), total duration and latency histogram
+        """
+        with self._lock:
+            return dict((operation, {
+                'calls': calls,
+                'errors': dict(self.errors[operation]),
+                'total_duration': self.total_duration[operation],
+                'latencies': list(zip(self.buckets + (None, ), self.latencies[operation])),
+            }) for operation, calls in self.calls.items())
+
+
+api_metrics = ApiMetrics()
+
+
+class StatsdExporter(object):
+    """
+    Sends a timer and a call counter for every operation, plus an error counter by exception type, to StatsD
+    """
+
+    def __init__(self):
+        try:
+            import statsd
+        except ImportError:
+            raise ImproperlyConfigured("The statsd package is required to export EasyPost metrics to StatsD")
+
+        self.client = statsd.StatsClient(getattr(settings, 'EASYPOST_STATSD_HOST', 'localhost'),
+                                         getattr(settings, 'EASYPOST_STATSD_PORT', 8125),
+                                         prefix=getattr(settings, 'EASYPOST_STATSD_PREFIX', 'easypost'))
+
+    def record(self, sender, operation, duration, error, **kwargs):
+        self.client.timing(operation, duration * 1000)
+        self.client.incr('{0}.calls'.format(operation))
+        if error is not None:
+            self.client.incr('{0}.errors.{1}'.format(operation, type(error).__name__))
+
+
+class PrometheusExporter(object):
+    """
+    Records EasyPost calls in prometheus_client metrics, which are exposed by whatever already serves the
+    process' Prometheus registry
+    """
+
+    def __init__(self):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured("The prometheus_client package is required to export EasyPost metrics "
+                                       "to Prometheus")
+
+        self.latency = prometheus_client.Histogram('easypost_api_call_seconds', 'EasyPost API call latency',
+                                                   ['operation'], buckets=ApiMetrics.buckets)
+        self.errors = prometheus_client.Counter('easypost_api_call_errors_total', 'EasyPost API call errors',
+                                                ['operation', 'error'])
+
+    def record(self, sender, operation, duration, error, **kwargs):
+        self.latency.labels(operation).observe(duration)
+        if error is not None:
+            self.errors.labels(operation, type(error).__name__).inc()
+
+
+EXPORTERS = {
+    'statsd': StatsdExporter,
+    'prometheus': PrometheusExporter,
+}
+
+_exporters = []
+
+
+def connect_metrics():
+    """
+    Connect api_metrics, and the exporters named in EASYPOST_METRICS_EXPORTERS, to api_call_finished
+    """
+    api_call_finished.connect(api_metrics.record, dispatch_uid='easypost_api_metrics')
+    if _exporters:
+        return
+
+    for name in getattr(settings, 'EASYPOST_METRICS_EXPORTERS', []):
+        try:
+            exporter = EXPORTERS[name]()
+        except KeyError:
+            raise ImproperlyConfigured("Unknown EasyPost metrics exporter '{0}'".format(name))
+        api_call_finished.connect(exporter.record, dispatch_uid='easypost_api_metrics_{0}'.format(name))
+        _exporters.append(exporter)
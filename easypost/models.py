@@ -1,13 +1,94 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
 from django.core.validators import MinValueValidator
 
+import datetime
+import hashlib
+
 import easypost
 easypost.api_key = settings.EASYPOST_API_KEY
 
+from .transport import configure_transport
+configure_transport()
+
+from .metrics import connect_metrics
+connect_metrics()
+
+from .api import call_api
+from .cache import shipment_cache
+from .storage import get_label_storage, download_label_file
+from .utils import concurrent_map, chunked, bulk_update
+
+
+class AddressManager(models.Manager):
+
+    def verify_many(self, addresses, concurrency=4):
+        """
+        Verify many addresses at once, see :meth:`Address.verify`
+
+        Stored AddressVerifications for all of the addresses are loaded in one query and the rest are verified with
+        EasyPost on up to `concurrency` threads, once per distinct fingerprint. New verifications are inserted with
+        one bulk_create() and the addresses are saved with batched UPDATEs (see utils.bulk_update()) in a single
+        transaction.
+
+        Returns a dict of address id to None if the address was verified, or the exception raised verifying it.
+        """
+        addresses = list(addresses)
+        fingerprints = dict((address.id, address.get_fingerprint()) for address in addresses)
+        verifications = AddressVerification.objects.get_current_many(fingerprints.values())
+
+        unverified = {}
+        for address in addresses:
+            if fingerprints[address.id] not in verifications:
+                unverified.setdefault(fingerprints[address.id], address)
+
+        errors = {}
+        new_verifications = []
+        easypost_ids = {}
+        for address, verified_address, error in concurrent_map(lambda address: address.verify_on_easypost(),
+                                                               unverified.values(), concurrency):
+            if error is not None:
+                errors[fingerprints[address.id]] = error
+            else:
+                new_verifications.append(AddressVerification.from_easypost(fingerprints[address.id], verified_address))
+                # the EasyPost address has this address' name, phone and email so it can't be shared
+                easypost_ids[address.id] = verified_address.id
+
+        results = {}
+        with transaction.atomic():
+            if new_verifications:
+                new_fingerprints = [verification.fingerprint for verification in new_verifications]
+                # replace any expired verifications
+                AddressVerification.objects.filter(fingerprint__in=new_fingerprints).delete()
+                AddressVerification.objects.bulk_create(new_verifications)
+                verifications.update((verification.fingerprint, verification) for verification in new_verifications)
+
+            verified = []
+            for address in addresses:
+                fingerprint = fingerprints[address.id]
+                if fingerprint in errors:
+                    results[address.id] = errors[fingerprint]
+                    continue
+
+                verifications[fingerprint].apply_to(address)
+                if address.id in easypost_ids:
+                    address.set_easypost_id(easypost_ids[address.id])
+                verified.append(address)
+                results[address.id] = None
+
+            bulk_update(self.all(), verified, ['street1', 'street2', 'city', 'state', 'zip_code', 'country',
+                                               'verified_address', 'easypost_id', 'easypost_checksum'])
+
+        return results
+
 
 class Address(models.Model):
     """
@@ -31,40 +112,317 @@ class Address(models.Model):
     phone = models.CharField(max_length=100, blank=True)
     email = models.CharField(max_length=200, blank=True)
     verified_address = models.BooleanField(blank=True, default=False)
+    easypost_id = models.CharField(max_length=75, null=True, blank=True, db_index=True)
+    # get_easypost_checksum() when easypost_id was set, the EasyPost address is only reused while it still matches
+    easypost_checksum = models.CharField(max_length=40, blank=True)
+
+    objects = AddressManager()
 
     class Meta:
         verbose_name_plural = "addresses"
 
+    def __unicode__(self):
+        return u'{0}, {1} {2}'.format(self.ship, self.city, self.zip_code)
+
+    def get_fingerprint(self):
+        """
+        A hash of the normalized street, city, state, zip code and country. Two addresses with the same
+        fingerprint are the same place, whoever they are for.
+        """
+        parts = [self.street1, self.street2, self.city, self.state, self.zip_code, self.country]
+        normalized = u'|'.join(u' '.join(force_text(part).lower().split()) for part in parts)
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
     def verify(self):
         """
         verifies address against EasyPost's API. Any variations in the address are saved back to the object.
+
+        The result is stored as an AddressVerification so the same address is not sent to EasyPost again
+        until EASYPOST_ADDRESS_VERIFICATION_TTL has passed.
         """
-        easypost_address = easypost.Address.create(
-            name=self.ship,
-            street1=self.street1,
-            street2=self.street2,
-            city=self.city,
-            state=self.state,
-            zip=self.zip_code,
-            country=self.country,
-            phone=self.phone,
-            email=self.email
-        )
-        try:
-            verified_from_address = easypost_address.verify()
-            self.name = verified_from_address.name,
-            self.street1 = verified_from_address.street1,
-            self.street1 = verified_from_address.street2,
-            self.city = verified_from_address.city,
-            self.state = verified_from_address.state,
-            self.zip_code = verified_from_address.zip,
-            self.country = verified_from_address.country,
-            self.phone = verified_from_address.phone,
-            self.verified_address = True
-            self.save()
-
-        except easypost.Error as e:
-            raise e
+        fingerprint = self.get_fingerprint()
+        verification = AddressVerification.objects.get_current(fingerprint)
+        if verification is None:
+            verified_address = self.verify_on_easypost()
+            verification = AddressVerification.objects.record(fingerprint, verified_address)
+            verification.apply_to(self)
+            self.set_easypost_id(verified_address.id)
+        else:
+            verification.apply_to(self)
+
+        self.save()
+
+    def verify_on_easypost(self):
+        """
+        Verifies the address with EasyPost, without any caching, and returns the verified easypost.Address
+        """
+        easypost_address = call_api('address.create', easypost.Address.create, **self.get_easypost_params())
+        return call_api('address.verify', easypost_address.verify)
+
+    def get_easypost_params(self):
+        """
+        The parameters for creating the address on EasyPost
+        """
+        return {
+            'name': self.ship,
+            'street1': self.street1,
+            'street2': self.street2,
+            'city': self.city,
+            'state': self.state,
+            'zip': self.zip_code,
+            'country': self.country,
+            'phone': self.phone,
+            'email': self.email
+        }
+
+    def get_easypost_checksum(self):
+        params = self.get_easypost_params()
+        return hashlib.sha1(u'|'.join(force_text(params[key]) for key in sorted(params)).encode('utf-8')).hexdigest()
+
+    def set_easypost_id(self, easypost_id):
+        """
+        Remember the EasyPost address created for this address as it is now. Does not save the address.
+        """
+        self.easypost_id = easypost_id
+        self.easypost_checksum = self.get_easypost_checksum() if easypost_id else ''
+
+    def has_current_easypost_id(self):
+        """
+        Whether the address has been created on EasyPost and not changed since
+        """
+        return bool(self.easypost_id) and self.easypost_checksum == self.get_easypost_checksum()
+
+    def get_easypost_reference(self):
+        """
+        The address for an EasyPost request, just its id if it has already been created on EasyPost
+        """
+        if self.has_current_easypost_id():
+            return {'id': self.easypost_id}
+        return self.get_easypost_params()
+
+
+class AddressVerificationManager(models.Manager):
+
+    def current(self):
+        """
+        The AddressVerifications which have not expired
+        """
+        ttl = getattr(settings, 'EASYPOST_ADDRESS_VERIFICATION_TTL', 30 * 24 * 60 * 60)
+        if ttl is None:
+            return self.all()
+        return self.filter(verified_date__gte=timezone.now() - datetime.timedelta(seconds=ttl))
+
+    def get_current(self, fingerprint):
+        """
+        Returns the AddressVerification for the fingerprint if there is one which has not expired
+        """
+        return self.current().filter(fingerprint=fingerprint).first()
+
+    def get_current_many(self, fingerprints):
+        """
+        Returns a dict of fingerprint to AddressVerification for the fingerprints which have one that has not expired
+        """
+        return dict((verification.fingerprint, verification)
+                    for verification in self.current().filter(fingerprint__in=set(fingerprints)))
+
+    def record(self, fingerprint, verified_address):
+        """
+        Stores the easypost.Address returned from verifying the address with the fingerprint
+        """
+        verification = self.model.from_easypost(fingerprint, verified_address)
+        defaults = dict((name, getattr(verification, name))
+                        for name in ['street1', 'street2', 'city', 'state', 'zip_code', 'country', 'verified_date'])
+        verification, created = self.update_or_create(fingerprint=fingerprint, defaults=defaults)
+        return verification
+
+
+class AddressVerification(models.Model):
+    """
+    The canonical address EasyPost returned when verifying an address, keyed on :meth:`Address.get_fingerprint`
+
+    Only the parts of the address covered by the fingerprint are stored, the name, phone and email belong to
+    whoever the address was for.
+    """
+    fingerprint = models.CharField(max_length=40, unique=True)
+    street1 = models.CharField(max_length=100)
+    street2 = models.CharField(max_length=100, blank=True)
+    city = models.CharField(max_length=100)
+    state = models.CharField(max_length=50)
+    zip_code = models.CharField(max_length=25)
+    country = models.CharField(max_length=50)
+
+    verified_date = models.DateTimeField(default=timezone.now)
+
+    objects = AddressVerificationManager()
+
+    def __unicode__(self):
+        return u'{0}'.format(self.fingerprint)
+
+    @classmethod
+    def from_easypost(cls, fingerprint, verified_address):
+        """
+        Create a new, unsaved, AddressVerification from a verified easypost.Address
+        """
+        return cls(fingerprint=fingerprint,
+                   street1=verified_address.street1 or '',
+                   street2=verified_address.street2 or '',
+                   city=verified_address.city or '',
+                   state=verified_address.state or '',
+                   zip_code=verified_address.zip or '',
+                   country=verified_address.country or '',
+                   verified_date=timezone.now())
+
+    def apply_to(self, address):
+        """
+        Copies the verified address onto an :class:`Address` and marks it as verified. Does not save the address.
+        """
+        address.street1 = self.street1
+        address.street2 = self.street2
+        address.city = self.city
+        address.state = self.state
+        address.zip_code = self.zip_code
+        address.country = self.country
+        address.verified_address = True
+
+
+class ShipmentManager(models.Manager):
+    id_cache_key = 'easypost:shipment_id:{0}'
+
+    def due_for_tracking(self, now=None):
+        """
+        Returns the shipments with a label whose tracking should be checked on EasyPost
+
+        Delivered and failed shipments are never due, the rest are due once the interval for their tracking status
+        in Shipment.TRACKING_POLL_INTERVALS has passed since they were last checked, on EasyPost or by a webhook.
+        Shipments which were never checked come first, then those checked longest ago.
+        """
+        now = now or timezone.now()
+        intervals = dict(Shipment.TRACKING_POLL_INTERVALS, **getattr(settings, 'EASYPOST_TRACKING_POLL_INTERVALS', {}))
+
+        due = models.Q()
+        for status, interval in intervals.items():
+            if status in (Shipment.Status.DELIVERED, Shipment.Status.FAILURE) or interval is None:
+                continue
+            has_status = models.Q(tracking_status=status)
+            if status == Shipment.Status.UNKNOWN:
+                has_status |= models.Q(tracking_status__isnull=True)
+            checked = now - datetime.timedelta(seconds=interval)
+            due |= has_status & (models.Q(tracking_checked_date__isnull=True) |
+                                 models.Q(tracking_checked_date__lt=checked))
+
+        if not due:
+            return self.none()
+        # NULLs sort last on some databases
+        never_checked = models.Case(models.When(tracking_checked_date__isnull=True, then=models.Value(0)),
+                                    default=models.Value(1), output_field=models.IntegerField())
+        return self.filter(due, label__isnull=False).annotate(never_checked=never_checked).order_by(
+            'never_checked', 'tracking_checked_date')
+
+    def get_ids_by_easypost_id(self, easypost_ids):
+        """
+        Returns a dict of EasyPost id to Shipment id for the shipments with the given EasyPost ids
+
+        If EASYPOST_SHIPMENT_ID_CACHE_TIMEOUT is set the ids are cached for that many seconds, so that the
+        webhook processing does not need to look shipments up at all.
+        """
+        easypost_ids = set(easypost_ids)
+        timeout = getattr(settings, 'EASYPOST_SHIPMENT_ID_CACHE_TIMEOUT', None)
+        if not timeout:
+            return dict(self.filter(easypost_id__in=easypost_ids).values_list('easypost_id', 'id'))
+
+        cache = caches[getattr(settings, 'EASYPOST_CACHE', 'default')]
+        cached = cache.get_many([self.id_cache_key.format(easypost_id) for easypost_id in easypost_ids])
+        ids = dict((easypost_id, cached[self.id_cache_key.format(easypost_id)]) for easypost_id in easypost_ids
+                   if self.id_cache_key.format(easypost_id) in cached)
+
+        missing = easypost_ids - set(ids)
+        if missing:
+            found = dict(self.filter(easypost_id__in=missing).values_list('easypost_id', 'id'))
+            cache.set_many(dict((self.id_cache_key.format(easypost_id), shipment_id)
+                                for easypost_id, shipment_id in found.items()), timeout)
+            ids.update(found)
+        return ids
+
+    def load_addresses(self, shipments):
+        """
+        Load the to and from addresses of all of the shipments with one query, skipping addresses already loaded
+        """
+        to_cache = Shipment._meta.get_field('to_address').get_cache_name()
+        from_cache = Shipment._meta.get_field('from_address').get_cache_name()
+        address_ids = set()
+        for shipment in shipments:
+            if not hasattr(shipment, to_cache):
+                address_ids.add(shipment.to_address_id)
+            if not hasattr(shipment, from_cache):
+                address_ids.add(shipment.from_address_id)
+        if not address_ids:
+            return
+
+        addresses = Address.objects.in_bulk(address_ids)
+        for shipment in shipments:
+            if not hasattr(shipment, to_cache):
+                shipment.to_address = addresses[shipment.to_address_id]
+            if not hasattr(shipment, from_cache):
+                shipment.from_address = addresses[shipment.from_address_id]
+
+    def create_many_on_easypost(self, shipments, parcels, customs_infos=None, concurrency=None):
+        """
+        Create many shipments on EasyPost at once, see :meth:`Shipment.create_on_easypost`
+
+        parcels, and customs_infos if given, are in the same order as shipments. The shipments are created on up to
+        `concurrency` (by default EASYPOST_SHIPMENT_CREATE_WORKERS) threads, then their EasyPost ids are saved and
+        their rates stored in one transaction. Raises ValueError if there is not a parcel for every shipment.
+
+        Returns a dict of shipment id to None if the shipment was created, or the exception raised creating it.
+        """
+        shipments = list(shipments)
+        parcels = list(parcels)
+        customs_infos = list(customs_infos) if customs_infos is not None else [None] * len(shipments)
+        if len(parcels) != len(shipments) or len(customs_infos) != len(shipments):
+            raise ValueError("There must be a parcel, and a customs info if any are given, for every shipment")
+        concurrency = concurrency or getattr(settings, 'EASYPOST_SHIPMENT_CREATE_WORKERS', 8)
+
+        # the parameters read the addresses from the database, so build them all before starting the threads
+        self.load_addresses(shipments)
+        params = [(shipment, shipment.get_easypost_create_params(parcel, customs_info))
+                  for shipment, parcel, customs_info in zip(shipments, parcels, customs_infos)]
+        results = concurrent_map(lambda item: call_api('shipment.create', easypost.Shipment.create, **item[1]),
+                                 params, concurrency)
+
+        errors = {}
+        created = []
+        created_easypost_shipments = []
+        rates = []
+        rates_date = timezone.now()
+        for (shipment, shipment_params), easypost_shipment, error in results:
+            if error is not None:
+                errors[shipment.id] = error
+                continue
+
+            shipment.easypost_id = easypost_shipment.id
+            shipment.rates_date = rates_date
+            shipment_cache.set(easypost_shipment)
+            created.append(shipment)
+            created_easypost_shipments.append(easypost_shipment)
+            rates.extend(ShipmentRate.from_easypost(shipment, rate)
+                         for rate in getattr(easypost_shipment, 'rates', None) or [])
+
+        if created:
+            # addresses shared by many shipments, like a warehouse, only need to be remembered once
+            remembered = set()
+            for shipment, easypost_shipment in zip(created, created_easypost_shipments):
+                remembered.update(address.id for address in shipment.remember_easypost_addresses(easypost_shipment,
+                                                                                                 exclude=remembered))
+
+            with transaction.atomic():
+                # batched UPDATEs setting each shipment's own easypost_id
+                bulk_update(self.all(), created, ['easypost_id'], rates_date=rates_date)
+                # rates from any earlier EasyPost shipments, like store_rates()
+                for batch in chunked(created, 500):
+                    ShipmentRate.objects.filter(shipment__in=batch).delete()
+                ShipmentRate.objects.bulk_create(rates)
+
+        return dict((shipment.id, errors.get(shipment.id)) for shipment in shipments)
 
 
 class Shipment(models.Model):
@@ -125,6 +483,12 @@ class Shipment(models.Model):
                       (Status.DELIVERED, Status.DELIVERED)
                       )
 
+    # seconds between checks of the tracking of shipments with each status, see ShipmentManager.due_for_tracking(),
+    # overridden by EASYPOST_TRACKING_POLL_INTERVALS
+    TRACKING_POLL_INTERVALS = {Status.IN_TRANSIT: 4 * 60 * 60,
+                               Status.PRE_TRANSIT: 12 * 60 * 60,
+                               Status.UNKNOWN: 12 * 60 * 60}
+
     REFUND_STATUS_CHOICES = ((RefundStatus.NONE, RefundStatus.NONE),
                              (RefundStatus.SUBMITTED, RefundStatus.SUBMITTED),
                              (RefundStatus.REJECTED, RefundStatus.REJECTED),
@@ -134,19 +498,32 @@ class Shipment(models.Model):
     to_address = models.ForeignKey('easypost.Address', related_name="shipments_to")
     from_address = models.ForeignKey('easypost.Address', related_name="shipments_from")
     is_return = models.BooleanField(blank=True, default=False)
-    refund_status = models.CharField(max_length=25, blank=True, choices=REFUND_STATUS_CHOICES, default=RefundStatus.NONE)
+    refund_status = models.CharField(max_length=25, blank=True, choices=REFUND_STATUS_CHOICES, default=RefundStatus.NONE,
+                                     db_index=True)
 
-    easypost_id = models.CharField(max_length=200, blank=True, null=True)
-    tracking_code = models.CharField(max_length=75, blank=True, null=True)
+    easypost_id = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    tracking_code = models.CharField(max_length=75, blank=True, null=True, db_index=True)
     tracking_status = models.CharField(max_length=25, choices=STATUS_CHOICES, default=Status.UNKNOWN, blank=True, null=True)
-    carrier = models.CharField(max_length=25, choices=CARRIER_CHOICES, default=Carrier.USPS)
+    # the newest ShipmentTrackingHistory, kept up to date by ShipmentTrackingHistoryManager.add_tracking_details()
+    latest_tracking_status = models.CharField(max_length=25, blank=True)
+    latest_tracking_message = models.TextField(blank=True)
+    latest_tracking_update_time = models.DateTimeField(blank=True, null=True)
+    tracking_checked_date = models.DateTimeField(blank=True, null=True,
+                                                 help_text=_('When the tracking was last checked on EasyPost'))
+    carrier = models.CharField(max_length=25, choices=CARRIER_CHOICES, default=Carrier.USPS, db_index=True)
     service = models.CharField(max_length=50, null=True, blank=True)
     rate = models.DecimalField(decimal_places=2, max_digits=10, help_text=_('Shipping cost'), null=True, blank=True)
+    rates_date = models.DateTimeField(blank=True, null=True, help_text=_('When the stored rates were fetched from EasyPost'))
 
     created_date = models.DateTimeField(blank=True, null=True, auto_now_add=True)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
                                    related_name="shipments")
 
+    objects = ShipmentManager()
+
+    class Meta:
+        index_together = [('tracking_status', 'tracking_checked_date')]
+
     def __unicode__(self):
         return u'{0}'.format(self.easypost_id)
 
@@ -154,52 +531,73 @@ class Shipment(models.Model):
         """
         Create the shipment on EasyPost. Requires an EasyPost parcel object
         """
-        to_address = {
-            'name': self.to_address.ship,
-            'street1': self.to_address.street1,
-            'street2': self.to_address.street2,
-            'city': self.to_address.city,
-            'state': self.to_address.state,
-            'zip': self.to_address.zip_code,
-            'country': self.to_address.country,
-            'phone': self.to_address.phone,
-            'email': self.to_address.email
-        }
-        from_address = {
-            'name': self.from_address.ship,
-            'street1': self.from_address.street1,
-            'street2': self.from_address.street2,
-            'city': self.from_address.city,
-            'state': self.from_address.state,
-            'zip': self.from_address.zip_code,
-            'country': self.from_address.country,
-            'phone': self.from_address.phone,
-            'email': self.from_address.email
-        }
-        shipment = easypost.Shipment.create(
-            to_address=to_address,
-            from_address=from_address,
-            parcel=parcel,
-            customs_info=customs_info,
-            is_return=self.is_return,
-            api_key=settings.EASYPOST_API_KEY
-        )
+        shipment = call_api('shipment.create', easypost.Shipment.create,
+                            **self.get_easypost_create_params(parcel, customs_info))
         self.easypost_id = shipment.id
         self.save()
+        shipment_cache.set(shipment)
+        self.store_rates(getattr(shipment, 'rates', None) or [])
+        self.remember_easypost_addresses(shipment)
         return shipment
 
-    def get_easypost_shipment(self):
+    def get_easypost_create_params(self, parcel, customs_info=None):
+        """
+        The parameters for creating the shipment with easypost.Shipment.create()
+
+        Addresses which have already been created on EasyPost are sent as just their id.
+        """
+        self.load_addresses()
+        return {
+            'to_address': self.to_address.get_easypost_reference(),
+            'from_address': self.from_address.get_easypost_reference(),
+            'parcel': parcel,
+            'customs_info': customs_info,
+            'is_return': self.is_return,
+            'api_key': settings.EASYPOST_API_KEY
+        }
+
+    def load_addresses(self):
+        """
+        Load the to and from addresses with one query, unless they have already been loaded
+        """
+        Shipment.objects.load_addresses([self])
+
+    def remember_easypost_addresses(self, easypost_shipment, exclude=None):
+        """
+        Store the ids of the EasyPost addresses created along with the shipment, so later shipments can
+        refer to them by id. Addresses whose id is in exclude are skipped. Returns the addresses updated.
+        """
+        updated = []
+        for address, easypost_address in [(self.to_address, getattr(easypost_shipment, 'to_address', None)),
+                                          (self.from_address, getattr(easypost_shipment, 'from_address', None))]:
+            if (exclude and address.id in exclude) or not getattr(easypost_address, 'id', None):
+                continue
+            if address.has_current_easypost_id() and address.easypost_id == easypost_address.id:
+                continue
+
+            address.set_easypost_id(easypost_address.id)
+            address.save(update_fields=['easypost_id', 'easypost_checksum'])
+            updated.append(address)
+        return updated
+
+    def get_easypost_shipment(self, refresh=False):
         """
         Gets the easypost.Shipment object from easypost
+
+        The shipment is cached, see easypost.cache.ShipmentCache. Pass refresh=True to always retrieve it from EasyPost.
         """
         assert(self.easypost_id)
-        return easypost.Shipment.retrieve(self.easypost_id)
+        shipment = None if refresh else shipment_cache.get(self.easypost_id)
+        if shipment is None:
+            shipment = call_api('shipment.retrieve', easypost.Shipment.retrieve, self.easypost_id)
+            shipment_cache.set(shipment)
+        return shipment
 
     def update_from_easypost(self):
         """
         Checks easypost for update to tracking code
         """
-        easypost_shipment = self.get_easypost_shipment()
+        easypost_shipment = self.get_easypost_shipment(refresh=True)
         self.tracking_code = easypost_shipment.tracking_code
 
         self.save()
@@ -210,9 +608,11 @@ class Shipment(models.Model):
 
         By default, EasyPost returns a label in PNG format. See Label.request_label_file() for other options.
 
-        Uses the default cheapest postage if postage choice is not provided.
+        Uses the default cheapest postage if postage choice is not provided, from the stored rates while they
+        are current. Unless a shipment is passed or there are no current rates, the label is bought without
+        retrieving the shipment from EasyPost.
         Updates the Shipment's rate, service, and carrier and then optionally saves the Shipment
-        if commit is True.  Default is True.
+        if commit is True.  Default is True. The Label and the Shipment are saved in one transaction.
         """
 
         # lowest_rate() requires carriers and services to either be iterable
@@ -233,39 +633,65 @@ class Shipment(models.Model):
         except Label.DoesNotExist:
             pass
 
-        # this is a bit slow since it's two lookups
-        if not shipment:
+        if not shipment and not rate and self.has_current_rates():
+            stored_rate = self.get_lowest_stored_rate(carriers=carriers, services=services)
+            if stored_rate is not None:
+                rate = stored_rate.to_easypost()
+
+        if not shipment and rate:
+            # buying with a known rate only needs the shipment id, the response has the postage label
+            shipment = easypost.Shipment(self.easypost_id, api_key=settings.EASYPOST_API_KEY)
+        elif not shipment:
             shipment = self.get_easypost_shipment()
 
         if not rate:
+            # picked from the shipment's rates without a request
             rate = shipment.lowest_rate(carriers=carriers, services=services)
 
-        l = shipment.buy(rate=rate)
+        l = call_api('shipment.buy', shipment.buy, rate=rate)
+        shipment_cache.delete(self.easypost_id)
         label = Label(shipment=self,
                       easypost_id=l.id)
 
         label.label_url = shipment.postage_label.label_url
         # these three show up in the documentation but the test api never returns them
-        label.label_pdf_url = getattr(l, 'label_pdf_url', '')
-        label.label_epl2_url = getattr(l, 'label_epl2_url', '')
-        label.label_zpl_url = getattr(l, 'label_zpl_url', '')
-        label.save()
+        label.label_pdf_url = getattr(shipment.postage_label, 'label_pdf_url', None) or ''
+        label.label_epl2_url = getattr(shipment.postage_label, 'label_epl2_url', None) or ''
+        label.label_zpl_url = getattr(shipment.postage_label, 'label_zpl_url', None) or ''
 
-        self.rate = rate.rate
+        # EasyPost rates are strings
+        self.rate = self._meta.get_field('rate').to_python(rate.rate)
         self.service = rate.service
         self.carrier = rate.carrier
-        if commit:
-            self.save(update_fields=['rate', 'service', 'carrier'])
+        with transaction.atomic():
+            label.save()
+            if commit:
+                self.save(update_fields=['rate', 'service', 'carrier'])
 
         return label
 
+    def get_lowest_stored_rate(self, carriers=None, services=None):
+        """
+        Returns the cheapest stored :class:`ShipmentRate`, optionally only for the given carriers and services,
+        matched without case like easypost.Shipment.lowest_rate(). Returns None if there is no such rate.
+        """
+        carriers = [carrier.lower() for carrier in carriers or []]
+        services = [service.lower() for service in services or []]
+        rates = [rate for rate in self.rates.all()
+                 if (not carriers or rate.carrier.lower() in carriers) and
+                 (not services or rate.service.lower() in services)]
+        if not rates:
+            return None
+        return min(rates, key=lambda rate: rate.rate)
+
     def refund(self):
         """
         Request a refund for this shipment from EasyPost
         """
         if not self.refund_status:
             shipment = self.get_easypost_shipment()
-            shipment.refund()
+            call_api('shipment.refund', shipment.refund)
+            shipment_cache.delete(self.easypost_id)
             self.refund_status = Shipment.RefundStatus.SUBMITTED
             self.save(update_fields=['refund_status'])
         # else raise an exception or return an error?
@@ -273,11 +699,26 @@ class Shipment(models.Model):
     def get_shipping_rates(self):
         """
         Returns all of the Rate objects available for this shipment
+
+        The shipment is re-rated on EasyPost and the new rates are stored, see store_rates()
         """
         shipment = self.get_easypost_shipment()
-        return shipment.get_rates().rates
+        rates = call_api('shipment.rates', shipment.get_rates).rates
+        self.store_rates(rates)
+        return rates
 
     def get_shipping_rate(self, rate_id):
+        """
+        Returns the Rate object with the id rate_id, or None
+
+        Uses the stored rates while they are current, otherwise the shipment is re-rated on EasyPost
+        """
+        if self.has_current_rates():
+            try:
+                return self.rates.get(easypost_id=rate_id).to_easypost()
+            except ShipmentRate.DoesNotExist:
+                return None
+
         rates = self.get_shipping_rates()
         for rate in rates:
             if rate.id == rate_id:
@@ -285,23 +726,103 @@ class Shipment(models.Model):
 
         return None
 
+    def store_rates(self, easypost_rates):
+        """
+        Replaces the stored :class:`ShipmentRate` snapshot for this shipment with the given EasyPost Rate objects
+        """
+        with transaction.atomic():
+            self.rates.all().delete()
+            ShipmentRate.objects.bulk_create([ShipmentRate.from_easypost(self, rate) for rate in easypost_rates])
+            self.rates_date = timezone.now()
+            self.save(update_fields=['rates_date'])
+
+    def has_current_rates(self):
+        """
+        Whether the stored rates are younger than EASYPOST_RATE_SNAPSHOT_TTL seconds
+        """
+        ttl = getattr(settings, 'EASYPOST_RATE_SNAPSHOT_TTL', 15 * 60)
+        return self.rates_date is not None and self.rates_date >= timezone.now() - datetime.timedelta(seconds=ttl)
+
     def update_tracking_history(self, status, message, update_time):
         """
         Adds a new ShipmentTrackingHistory if one does not already exist
-        which matches the status, message, and update time for this shipment
+        which matches the status, message, and update time for this shipment, see update_tracking_histories()
+        """
+        self.update_tracking_histories([(status, message, update_time)])
+
+    def update_tracking_histories(self, histories):
         """
-        ShipmentTrackingHistory.objects.get_or_create(shipment=self,
-                                                      status=status,
-                                                      message=message,
-                                                      update_time=update_time)
+        Adds ShipmentTrackingHistory rows for every (status, message, update_time) in histories
+        which has not already been stored for this shipment. See
+        ShipmentTrackingHistoryManager.add_tracking_details()
+        """
+        return ShipmentTrackingHistory.objects.add_tracking_details(
+            (self.id, status, message, update_time) for status, message, update_time in histories)
 
     def get_latest_tracking_update(self):
+        """
+        Returns the newest ShipmentTrackingHistory. The latest_tracking_* fields hold the same status, message
+        and update time without a query.
+        """
         try:
-            return self.shipmenttrackinghistory_set.latest('date_created')
+            return self.shipmenttrackinghistory_set.latest('update_time')
         except ShipmentTrackingHistory.DoesNotExist:
             return None
 
 
+@receiver(post_delete, sender=Shipment, dispatch_uid='easypost_shipment_id_cache')
+def delete_cached_shipment_id(sender, instance, **kwargs):
+    if instance.easypost_id and getattr(settings, 'EASYPOST_SHIPMENT_ID_CACHE_TIMEOUT', None):
+        caches[getattr(settings, 'EASYPOST_CACHE', 'default')].delete(
+            ShipmentManager.id_cache_key.format(instance.easypost_id))
+
+
+class ShipmentRate(models.Model):
+    """
+    A rate EasyPost returned for a :class:`Shipment`, stored so that it can be looked up without calling EasyPost
+    """
+    shipment = models.ForeignKey('Shipment', related_name='rates')
+    easypost_id = models.CharField(max_length=75, unique=True)
+    carrier = models.CharField(max_length=25)
+    service = models.CharField(max_length=50)
+    rate = models.DecimalField(decimal_places=2, max_digits=10)
+    currency = models.CharField(max_length=3, blank=True)
+    delivery_days = models.PositiveIntegerField(blank=True, null=True)
+
+    created_date = models.DateTimeField(blank=True, null=True, auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{0} {1} {2}'.format(self.carrier, self.service, self.rate)
+
+    @classmethod
+    def from_easypost(cls, shipment, easypost_rate):
+        """
+        Create a new, unsaved, ShipmentRate from an easypost Rate object
+        """
+        return cls(shipment=shipment,
+                   easypost_id=easypost_rate.id,
+                   carrier=easypost_rate.carrier,
+                   service=easypost_rate.service,
+                   rate=easypost_rate.rate,
+                   currency=getattr(easypost_rate, 'currency', None) or '',
+                   delivery_days=getattr(easypost_rate, 'delivery_days', None))
+
+    def to_easypost(self):
+        """
+        Returns the rate as an easypost Rate object, which can be passed to :meth:`Shipment.buy_label`
+        """
+        return easypost.convert_to_easypost_object({
+            'object': 'Rate',
+            'id': self.easypost_id,
+            'shipment_id': self.shipment.easypost_id,
+            'carrier': self.carrier,
+            'service': self.service,
+            'rate': str(self.rate),
+            'currency': self.currency,
+            'delivery_days': self.delivery_days,
+        }, settings.EASYPOST_API_KEY)
+
+
 class ShipmentItem(models.Model):
     """
     A single item in a :class:`shipments.models.Shipment` relating to an :class:`orders.models.OrderItem`
@@ -315,6 +836,42 @@ class ShipmentItem(models.Model):
     count = models.PositiveIntegerField()
 
 
+class LabelManager(models.Manager):
+
+    def archive_files(self, labels, formats=None, workers=None):
+        """
+        Download the files of many labels from EasyPost into the label storage, see easypost.storage
+
+        Each of the formats (all of Label.LABEL_FORMATS by default) which has a url but has not been archived
+        yet is downloaded, on up to EASYPOST_LABEL_DOWNLOAD_WORKERS threads across all of the labels.
+        A download which fails is logged and skipped. Returns the number of files archived.
+        """
+        labels = list(labels)
+        formats = formats or Label.LABEL_FORMATS
+        workers = workers or getattr(settings, 'EASYPOST_LABEL_DOWNLOAD_WORKERS', 8)
+        storage = get_label_storage()
+
+        downloads = [(label, format) for label in labels for format in formats
+                     if getattr(label, Label.LABEL_URL_FIELDS[format]) and
+                     not getattr(label, Label.LABEL_FILE_FIELDS[format])]
+
+        def download(item):
+            label, format = item
+            return download_label_file(getattr(label, Label.LABEL_URL_FIELDS[format]), format, storage)
+
+        archived = {}
+        for (label, format), name, error in concurrent_map(download, downloads, workers):
+            if error is None:
+                setattr(label, Label.LABEL_FILE_FIELDS[format], name)
+                archived.setdefault(label.pk, []).append(Label.LABEL_FILE_FIELDS[format])
+
+        for label in labels:
+            if label.pk in archived:
+                label.save(update_fields=archived[label.pk])
+
+        return sum(len(fields) for fields in archived.values())
+
+
 class Label(models.Model):
     """
     A shipping label
@@ -328,16 +885,34 @@ class Label(models.Model):
 
     LABEL_FORMATS = [LabelFormats.ZPL, LabelFormats.PDF, LabelFormats.EPL2, LabelFormats.PNG]
 
+    # the EasyPost PostageLabel attribute, and the field here, holding the url for each format
+    LABEL_URL_FIELDS = {LabelFormats.PNG: 'label_url',
+                        LabelFormats.PDF: 'label_pdf_url',
+                        LabelFormats.EPL2: 'label_epl2_url',
+                        LabelFormats.ZPL: 'label_zpl_url'}
+
+    # the field holding the name of the archived copy of each format in the label storage
+    LABEL_FILE_FIELDS = {LabelFormats.PNG: 'label_file',
+                         LabelFormats.PDF: 'label_pdf_file',
+                         LabelFormats.EPL2: 'label_epl2_file',
+                         LabelFormats.ZPL: 'label_zpl_file'}
+
     shipment = models.OneToOneField('Shipment')
     easypost_id = models.CharField(max_length=75, null=True, blank=True)  # should match the shipment id
     label_url = models.CharField(max_length=200, blank=True)
     label_pdf_url = models.CharField(max_length=200, blank=True)
     label_epl2_url = models.CharField(max_length=200, blank=True)
     label_zpl_url = models.CharField(max_length=200, blank=True)
+    label_file = models.CharField(max_length=200, blank=True)
+    label_pdf_file = models.CharField(max_length=200, blank=True)
+    label_epl2_file = models.CharField(max_length=200, blank=True)
+    label_zpl_file = models.CharField(max_length=200, blank=True)
 
     created_date = models.DateTimeField(blank=True, null=True, auto_now_add=True)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
 
+    objects = LabelManager()
+
     def request_label_file(self, format='pdf', commit=False):
         """
         Request the label in a specific format from EasyPost and saves the url
@@ -346,7 +921,9 @@ class Label(models.Model):
         # if pdf is needed right away or epl2 or zpl are needed at all, then separate rquests
         # must be made to EasyPost
         shipment = self.shipment.get_easypost_shipment()
-        shipment.label(file_format=format)  # this will raise an exception if no label has been bought yet
+        # this will raise an exception if no label has been bought yet
+        call_api('shipment.label', shipment.label, file_format=format)
+        shipment_cache.delete(self.shipment.easypost_id)
 
         # update all of them
         self.label_url = shipment.postage_label.label_url
@@ -357,6 +934,56 @@ class Label(models.Model):
         if commit:
             self.save(update_fields=['label_url', 'label_pdf_url', 'label_epl2_url', 'label_zpl_url'])
 
+    def request_label_files(self, formats=None, commit=True):
+        """
+        Request the label in several formats from EasyPost at once and save all of the urls
+
+        The formats (all of LABEL_FORMATS by default) are requested concurrently on up to
+        EASYPOST_LABEL_FORMAT_WORKERS threads. A format which fails is logged and skipped.
+        Returns the list of formats which were generated.
+        """
+        formats = formats or self.LABEL_FORMATS
+        easypost_id = self.shipment.easypost_id
+
+        def request_label(format):
+            # the label endpoint only needs the shipment id, so rather than retrieving the shipment
+            # each thread requests its format on its own bare shipment object
+            shipment = easypost.Shipment(easypost_id, api_key=settings.EASYPOST_API_KEY)
+            return call_api('shipment.label', shipment.label, file_format=format).postage_label
+
+        results = concurrent_map(request_label, formats, getattr(settings, 'EASYPOST_LABEL_FORMAT_WORKERS', 4))
+        shipment_cache.delete(easypost_id)
+
+        generated = []
+        for format, postage_label, error in results:
+            if error is not None:
+                continue
+            generated.append(format)
+            for field in self.LABEL_URL_FIELDS.values():
+                url = getattr(postage_label, field, '')
+                if url:
+                    setattr(self, field, url)
+
+        if commit:
+            self.save(update_fields=list(self.LABEL_URL_FIELDS.values()))
+
+        return generated
+
+    def archive_files(self, formats=None):
+        """
+        Download the label files from EasyPost into the label storage, see LabelManager.archive_files()
+        """
+        return Label.objects.archive_files([self], formats=formats)
+
+    def open_file(self, format='pdf'):
+        """
+        Open the archived copy of the label in a format, returns None if it has not been archived
+        """
+        name = getattr(self, self.LABEL_FILE_FIELDS[format])
+        if not name:
+            return None
+        return get_label_storage().open(name)
+
 
 class Parcel(models.Model):
     class USPSPredefinedPackage:
@@ -468,21 +1095,58 @@ class Parcel(models.Model):
 
         return "Parcel for shipment id {0} with dimensions [{1}]".format(self.shipment_id, dimensions)
 
-    def create_on_easypost(self):
-        try:
-            easypost_parcel = easypost.Parcel.create(
-                predefined_package=self.predefined_package,
-                length=self.length,
-                width=self.width,
-                height=self.height,
-                weight=self.weight
-            )
-            self.easypost_id = easypost_parcel.id
-            self.save()
-            return easypost_parcel
-
-        except easypost.Error as e:
-            raise e
+    def create_on_easypost(self, reuse=True):
+        """
+        Create the parcel on EasyPost and return the easypost Parcel object
+
+        Unless reuse is False, an EasyPost parcel already created with the same signature (see get_signature())
+        is used instead of creating another one.
+        """
+        signature = self.get_signature()
+        easypost_id = None
+        if reuse:
+            easypost_id = ParcelSignature.objects.filter(signature=signature).values_list('easypost_id', flat=True).first()
+
+        if easypost_id:
+            easypost_parcel = easypost.convert_to_easypost_object({
+                'object': 'Parcel',
+                'id': easypost_id,
+                'predefined_package': self.predefined_package,
+                'length': self.length,
+                'width': self.width,
+                'height': self.height,
+                'weight': self.weight
+            }, settings.EASYPOST_API_KEY)
+        else:
+            try:
+                easypost_parcel = call_api(
+                    'parcel.create',
+                    easypost.Parcel.create,
+                    predefined_package=self.predefined_package,
+                    length=self.length,
+                    width=self.width,
+                    height=self.height,
+                    weight=self.weight
+                )
+            except easypost.Error as e:
+                raise e
+            ParcelSignature.objects.get_or_create(signature=signature, defaults={'easypost_id': easypost_parcel.id})
+
+        self.easypost_id = easypost_parcel.id
+        self.save()
+        return easypost_parcel
+
+    def get_signature(self):
+        """
+        Identifies parcels which are the same to EasyPost: the predefined package, or else the dimensions,
+        and the weight, each to EasyPost's precision of 0.1
+        """
+        weight = u'{0:.1f}'.format(self.weight)
+        if self.predefined_package:
+            return u'{0}|{1}'.format(self.predefined_package, weight)
+        dimensions = [u'{0:.1f}'.format(value) if value is not None else u''
+                      for value in (self.length, self.width, self.height)]
+        return u'{0}|{1}'.format(u'x'.join(dimensions), weight)
 
     @classmethod
     def create_from_easypost_object(cls, easypost_parcel, shipment):
@@ -501,14 +1165,280 @@ class Parcel(models.Model):
         return parcel
 
 
+class ParcelSignature(models.Model):
+    """
+    An EasyPost parcel which can be reused for any :class:`Parcel` with the same :meth:`Parcel.get_signature`
+    """
+    signature = models.CharField(max_length=100, unique=True)
+    easypost_id = models.CharField(max_length=75)
+
+    created_date = models.DateTimeField(blank=True, null=True, auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{0}'.format(self.signature)
+
+
+class ShipmentTrackingHistoryManager(models.Manager):
+
+    def add_tracking_details(self, details):
+        """
+        Adds a ShipmentTrackingHistory for each (shipment_id, status, message, update_time) in details
+        which does not already exist.
+
+        EasyPost sends the full tracking history with every update, so rather than a get_or_create()
+        per entry the existing entries for all of the shipments are loaded in one query and only the
+        new ones are inserted with a single bulk_create(). The latest_tracking_* fields of each shipment
+        with a newer history are then updated in batches, see utils.bulk_update(). Returns the list of new histories.
+        """
+        # entries are compared on their tracking_key, see ShipmentTrackingHistory.get_tracking_key()
+        keyed = {}
+        for shipment_id, status, message, update_time in details:
+            tracking_key = self.model.get_tracking_key(status, message, update_time)
+            keyed[shipment_id, tracking_key] = (status, message, update_time)
+        if not keyed:
+            return []
+
+        shipment_ids = set(shipment_id for shipment_id, key in keyed)
+        existing = set(self.filter(shipment_id__in=shipment_ids).values_list('shipment_id', 'tracking_key'))
+        histories = [self.model(shipment_id=shipment_id, tracking_key=key, status=status, message=message,
+                                update_time=update_time)
+                     for (shipment_id, key), (status, message, update_time) in keyed.items()
+                     if (shipment_id, key) not in existing]
+        histories.sort(key=lambda history: history.update_time)
+        if not histories:
+            return []
+
+        try:
+            with transaction.atomic():
+                self.bulk_create(histories)
+        except IntegrityError:
+            # another worker stored some of the same updates in the meantime, fall back to one at a time
+            for history in histories:
+                self.get_or_create(shipment_id=history.shipment_id,
+                                   tracking_key=history.tracking_key,
+                                   defaults={'status': history.status,
+                                             'message': history.message,
+                                             'update_time': history.update_time})
+
+        latest = {}
+        for history in histories:
+            # histories are in update_time order
+            latest[history.shipment_id] = Shipment(id=history.shipment_id,
+                                                   latest_tracking_status=history.status,
+                                                   latest_tracking_message=history.message,
+                                                   latest_tracking_update_time=history.update_time)
+        # only where the shipment does not have a newer update already
+        bulk_update(Shipment.objects.all(), latest.values(),
+                    ['latest_tracking_status', 'latest_tracking_message', 'latest_tracking_update_time'],
+                    batch_size=50,
+                    condition=lambda shipment: (
+                        models.Q(latest_tracking_update_time__isnull=True) |
+                        models.Q(latest_tracking_update_time__lt=shipment.latest_tracking_update_time)))
+
+        return histories
+
+    def backfill_tracking_keys(self, batch_size=1000):
+        """
+        Set the tracking_key of histories stored before it was added, which have an empty one
+
+        Histories which turn out to be the same update as another history of their shipment are deleted, so that
+        the unique constraint on shipment and tracking_key can be added afterwards.
+        Returns a tuple of the number of histories updated and deleted.
+        """
+        updated = deleted = 0
+        missing = self.filter(tracking_key='').order_by('id').only('id', 'shipment', 'status', 'message',
+                                                                  'update_time')
+        while True:
+            # every history in the batch is either updated or deleted, so the next batch is the next one missing
+            histories = list(missing[:batch_size])
+            if not histories:
+                return updated, deleted
+
+            seen = set(self.filter(shipment_id__in=set(history.shipment_id for history in histories))
+                       .exclude(tracking_key='').values_list('shipment_id', 'tracking_key'))
+            keyed = []
+            duplicates = []
+            for history in histories:
+                history.tracking_key = self.model.get_tracking_key(history.status, history.message,
+                                                                   history.update_time)
+                if (history.shipment_id, history.tracking_key) in seen:
+                    duplicates.append(history.id)
+                else:
+                    seen.add((history.shipment_id, history.tracking_key))
+                    keyed.append(history)
+
+            with transaction.atomic():
+                self.filter(id__in=duplicates).delete()
+                bulk_update(self.all(), keyed, ['tracking_key'])
+            updated += len(keyed)
+            deleted += len(duplicates)
+
+
 class ShipmentTrackingHistory(models.Model):
     shipment = models.ForeignKey('Shipment')
     status = models.CharField(max_length=25)
     message = models.TextField()
     update_time = models.DateTimeField(help_text="The datetime given on the tracking update from EasyPost")
+    # get_tracking_key() of the status, message and update_time, which are unique per shipment
+    tracking_key = models.CharField(max_length=40)
 
     created_date = models.DateTimeField(blank=True, null=True, auto_now_add=True)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
 
+    objects = ShipmentTrackingHistoryManager()
+
+    class Meta:
+        unique_together = ('shipment', 'tracking_key')
+        index_together = [('shipment', 'update_time')]
+
     def __unicode__(self):
         return u'{0}'.format(self.message)
+
+    def save(self, *args, **kwargs):
+        if not self.tracking_key:
+            self.tracking_key = self.get_tracking_key(self.status, self.message, self.update_time)
+        super(ShipmentTrackingHistory, self).save(*args, **kwargs)
+
+    @staticmethod
+    def get_tracking_key(status, message, update_time):
+        """
+        Returns a sha1 hex digest identifying a tracking update by its status, message and update time
+
+        The message can be too long to be part of a unique index on some databases, so histories are
+        unique on this instead.
+        """
+        if timezone.is_aware(update_time):
+            update_time = update_time.astimezone(timezone.utc)
+        value = u'\n'.join([force_text(status), force_text(message), update_time.isoformat()])
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class WebhookEventManager(models.Manager):
+
+    def is_processed(self, easypost_id):
+        return self.filter(easypost_id=easypost_id).exists()
+
+    def claim(self, easypost_id):
+        """
+        Record that the event with this EasyPost id is being processed. Returns False if it already has been.
+
+        Call this in the same transaction as processing the event, so that the claim is released if processing fails.
+        """
+        try:
+            with transaction.atomic():
+                self.create(easypost_id=easypost_id)
+        except IntegrityError:
+            return False
+        return True
+
+    def claim_many(self, easypost_ids):
+        """
+        Record that the events with these EasyPost ids are being processed, see claim().
+        Returns the set of ids which had not already been processed.
+        """
+        easypost_ids = set(easypost_ids)
+        if not easypost_ids:
+            return set()
+
+        new_ids = easypost_ids - set(self.filter(easypost_id__in=easypost_ids).values_list('easypost_id', flat=True))
+        try:
+            with transaction.atomic():
+                self.bulk_create([self.model(easypost_id=easypost_id) for easypost_id in new_ids])
+        except IntegrityError:
+            # some were claimed by another worker in the meantime
+            return set(easypost_id for easypost_id in new_ids if self.claim(easypost_id))
+        return new_ids
+
+    def purge(self, ttl):
+        """
+        Forget events processed more than ttl seconds ago
+        """
+        return self.filter(created_date__lt=timezone.now() - datetime.timedelta(seconds=ttl)).delete()
+
+
+class WebhookEvent(models.Model):
+    """
+    An EasyPost webhook event which has been processed, so repeated deliveries of the same event can be ignored
+    """
+    easypost_id = models.CharField(max_length=75, unique=True)
+
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = WebhookEventManager()
+
+    def __unicode__(self):
+        return u'{0}'.format(self.easypost_id)
+
+
+class BufferedTrackerUpdateManager(models.Manager):
+
+    def buffer(self, easypost_shipment_id, payload, updated_at, schedule_timeout):
+        """
+        Store the newest tracker update for a shipment until it is applied, unless a newer one is already stored
+
+        updated_at is the tracker's updated_at, or None if it has none, in which case it is taken to be the newest.
+        The row is locked while it is compared, so concurrent updates can not overwrite a newer one with an older
+        one. Returns True if the caller should schedule applying the update, which is when no update was waiting or
+        the last one was scheduled more than schedule_timeout seconds ago.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            update, created = self.get_or_create(easypost_shipment_id=easypost_shipment_id,
+                                                 defaults={'payload': payload, 'updated_at': updated_at,
+                                                           'pending': True, 'scheduled_date': now})
+            if created:
+                return True
+
+            update = self.select_for_update().get(id=update.id)
+            if updated_at is not None and update.updated_at is not None and updated_at < update.updated_at:
+                # an update arrived out of order after a newer one
+                return False
+
+            schedule = (not update.pending or update.scheduled_date is None or
+                        update.scheduled_date < now - datetime.timedelta(seconds=schedule_timeout))
+            update.payload = payload
+            update.updated_at = updated_at or update.updated_at
+            update.pending = True
+            if schedule:
+                update.scheduled_date = now
+            update.save()
+            return schedule
+
+    def purge(self, ttl):
+        """
+        Forget applied updates last changed more than ttl seconds ago
+        """
+        return self.filter(pending=False, modified_date__lt=timezone.now() - datetime.timedelta(seconds=ttl)).delete()
+
+
+class BufferedTrackerUpdate(models.Model):
+    """
+    The newest EasyPost tracker update for a shipment, buffered to be applied once per coalescing window,
+    see easypost.tasks.coalesce_tracker_update
+
+    Applied updates are kept, with pending False, so that older updates arriving late can still be ignored.
+    """
+    easypost_shipment_id = models.CharField(max_length=200, unique=True)
+    payload = models.TextField()
+    updated_at = models.DateTimeField(blank=True, null=True, help_text="The updated_at of the tracker")
+    pending = models.BooleanField(default=True)
+    scheduled_date = models.DateTimeField(blank=True, null=True)
+
+    modified_date = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = BufferedTrackerUpdateManager()
+
+    def __unicode__(self):
+        return u'{0}'.format(self.easypost_shipment_id)
+
+
+class PendingWebhookEvent(models.Model):
+    """
+    The JSON from an EasyPost webhook POST waiting to be processed in a batch, see easypost.tasks.queue_webhook_event
+    """
+    payload = models.TextField()
+
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{0}'.format(self.id)
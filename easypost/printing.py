@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import tempfile
+
+from .models import Label
+from .storage import get_label_storage
+from .transport import get_session
+from .utils import concurrent_imap
+
+# formats whose files can simply be concatenated and sent to the printer as one job
+CONCATENATED_FORMATS = [Label.LabelFormats.ZPL, Label.LabelFormats.EPL2]
+
+
+def iter_label_chunks(label, format, storage=None):
+    """
+    Yield the file of a label in a format in chunks of EASYPOST_LABEL_DOWNLOAD_CHUNK_SIZE bytes, from its
+    archived copy if there is one (see Label.archive_files()) or else from its EasyPost url
+    """
+    chunk_size = getattr(settings, 'EASYPOST_LABEL_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+    name = getattr(label, Label.LABEL_FILE_FIELDS[format])
+    if name:
+        label_file = (storage or get_label_storage()).open(name)
+        try:
+            for chunk in label_file.chunks(chunk_size):
+                yield chunk
+        finally:
+            label_file.close()
+        return
+
+    url = getattr(label, Label.LABEL_URL_FIELDS[format])
+    if not url:
+        raise ValueError("Label {0} has no {1} file".format(label.id, format))
+
+    response = get_session().get(url, stream=True)
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
+
+def fetch_label_file(label, format, storage=None):
+    """
+    Returns the file of a label in a format as a temporary file, which is only kept in memory while it is
+    smaller than EASYPOST_PRINT_SPOOL_SIZE bytes
+    """
+    temp = tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'EASYPOST_PRINT_SPOOL_SIZE', 1024 * 1024))
+    try:
+        for chunk in iter_label_chunks(label, format, storage):
+            temp.write(chunk)
+    except Exception:
+        temp.close()
+        raise
+    temp.seek(0)
+    return temp
+
+
+def close_label_file(label_file):
+    label_file.close()
+
+
+def iter_label_files(labels, format, workers=None):
+    """
+    Yield (label, file) for each of labels in order, with the files fetched on up to EASYPOST_PRINT_WORKERS
+    threads, at most that many of them ahead of the one being consumed. Each file is closed once the next
+    one is yielded, and the files fetched ahead are closed if the consumer stops early. Raises the error of the
+    first label which could not be fetched.
+    """
+    workers = workers or getattr(settings, 'EASYPOST_PRINT_WORKERS', 8)
+    storage = get_label_storage()
+
+    for label, label_file, error in concurrent_imap(lambda label: fetch_label_file(label, format, storage),
+                                                    labels, workers, cleanup=close_label_file):
+        if error is not None:
+            raise error
+        try:
+            yield label, label_file
+        finally:
+            label_file.close()
+
+
+def iter_print_file(labels, format=Label.LabelFormats.ZPL, workers=None):
+    """
+    Yield one ZPL or EPL2 print job for all of labels, in order, as chunks of bytes
+
+    labels can be a queryset or any iterable of Labels, which is consumed as the job is written. Only a
+    bounded number of label files are held at once, see iter_label_files().
+    """
+    if format not in CONCATENATED_FORMATS:
+        raise ValueError("Only {0} labels can be concatenated, not {1}".format(
+            ', '.join(CONCATENATED_FORMATS), format))
+
+    chunk_size = getattr(settings, 'EASYPOST_LABEL_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+    for label, label_file in iter_label_files(labels, format, workers):
+        chunk = b''
+        for chunk in iter(lambda: label_file.read(chunk_size), b''):
+            yield chunk
+        # keep each label's last command on its own line
+        if chunk and not chunk.endswith(b'\n'):
+            yield b'\n'
+
+
+def write_print_file(labels, output, format=Label.LabelFormats.ZPL, workers=None):
+    """
+    Write one print job for all of labels, in order, to the binary file object output
+
+    ZPL and EPL2 labels are concatenated, see iter_print_file(). PDF labels are merged into one document,
+    which needs the PyPDF2 package; the pages are only read from the label files as the document is written,
+    but all of the label files are kept until then.
+    """
+    if format in CONCATENATED_FORMATS:
+        for chunk in iter_print_file(labels, format, workers):
+            output.write(chunk)
+        return
+
+    if format != Label.LabelFormats.PDF:
+        raise ValueError("{0} labels can not be merged into one print file".format(format))
+
+    try:
+        from PyPDF2 import PdfFileReader, PdfFileWriter
+    except ImportError:
+        raise ImproperlyConfigured("The PyPDF2 package is required to merge PDF labels")
+
+    label_files = []
+    writer = PdfFileWriter()
+    try:
+        workers = workers or getattr(settings, 'EASYPOST_PRINT_WORKERS', 8)
+        storage = get_label_storage()
+        for label, label_file, error in concurrent_imap(lambda label: fetch_label_file(label, format, storage),
+                                                        labels, workers, cleanup=close_label_file):
+            if error is not None:
+                raise error
+            label_files.append(label_file)
+            reader = PdfFileReader(label_file)
+            for page in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page))
+        writer.write(output)
+    finally:
+        for label_file in label_files:
+            label_file.close()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+
+import random
+import time
+
+
+def is_rate_limited(error):
+    """
+    Whether an exception raised by an EasyPost call is a rate limited (429) response
+    """
+    status = getattr(error, 'http_status', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status == 429
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of EasyPost calls made by every process sharing the Django cache named by EASYPOST_CACHE
+
+    EASYPOST_RATE_LIMITS maps buckets to the calls per second allowed for them, e.g.
+    ``{'default': 10, 'shipment.create': 5, 'shipment.retrieve': None}``. Each call is counted against the
+    bucket for its operation name, else the bucket for its resource (the part of the name before the dot),
+    else 'default', and waits for the next second if that bucket is full. None means no limit.
+
+    When EasyPost rate limits a call anyway, every process waits the Retry-After time, or an exponential
+    backoff with jitter, before calling that bucket again, and the bucket's limit is halved. The limit then
+    recovers a little every second, so the rate settles just under the limit EasyPost allows.
+    """
+    key_prefix = 'easypost:ratelimit:'
+    min_scale = 0.1
+    recovery = 0.05
+
+    def __init__(self, sleep=time.sleep, clock=time.time):
+        self.sleep = sleep
+        self.clock = clock
+
+    @property
+    def limits(self):
+        return getattr(settings, 'EASYPOST_RATE_LIMITS', None) or {}
+
+    @property
+    def retries(self):
+        return getattr(settings, 'EASYPOST_RATE_LIMIT_RETRIES', 3)
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'EASYPOST_CACHE', 'default')]
+
+    def get_bucket(self, operation):
+        """
+        Returns the bucket for an operation and its limit
+        """
+        limits = self.limits
+        for bucket in (operation, operation.split('.')[0]):
+            if bucket in limits:
+                return bucket, limits[bucket]
+        return 'default', limits.get('default')
+
+    def acquire(self, operation):
+        """
+        Wait until a call for operation is allowed
+        """
+        bucket, limit = self.get_bucket(operation)
+        cooldown_key = self.key_prefix + bucket + ':cooldown'
+        scale_key = self.key_prefix + bucket + ':scale'
+
+        while True:
+            now = self.clock()
+            values = self.cache.get_many([cooldown_key, scale_key])
+            cooldown = values.get(cooldown_key)
+            if cooldown and cooldown > now:
+                self.sleep(cooldown - now + random.uniform(0, 0.1))
+                continue
+            if not limit:
+                return
+
+            window = int(now)
+            key = '{0}{1}:{2}'.format(self.key_prefix, bucket, window)
+            scale = values.get(scale_key, 1.0)
+            if self.cache.add(key, 1, 2):
+                count = 1
+                if scale < 1.0:
+                    # the first call in each second lets a reduced limit recover
+                    self.cache.set(scale_key, min(1.0, scale + self.recovery), 60 * 60)
+            else:
+                try:
+                    count = self.cache.incr(key)
+                except ValueError:
+                    # the window expired in between
+                    continue
+
+            if count <= max(1, int(limit * scale)):
+                return
+            self.sleep(window + 1 - now + random.uniform(0, 0.05))
+
+    def backoff(self, operation, attempt, retry_after=None):
+        """
+        Record that a call for operation was rate limited on its attempt'th retry, so that every process waits
+        retry_after seconds, or an exponential backoff, before the next call for its bucket
+        """
+        bucket = self.get_bucket(operation)[0]
+        if retry_after is None:
+            delay = min(getattr(settings, 'EASYPOST_RATE_LIMIT_MAX_BACKOFF', 60),
+                        getattr(settings, 'EASYPOST_RATE_LIMIT_BACKOFF', 1.0) * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+        else:
+            delay = retry_after
+
+        cooldown_key = self.key_prefix + bucket + ':cooldown'
+        scale_key = self.key_prefix + bucket + ':scale'
+        now = self.clock()
+        cooldown = self.cache.get(cooldown_key)
+        if not cooldown or cooldown <= now:
+            # calls rate limited during the same cooldown only reduce the limit once
+            self.cache.set(scale_key, max(self.min_scale, self.cache.get(scale_key, 1.0) / 2), 60 * 60)
+        cooldown = max(cooldown or 0, now + delay)
+        self.cache.set(cooldown_key, cooldown, int(cooldown - now) + 1)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+
+# Sent after every request to the EasyPost API made through easypost.api.call_api(). operation names the call,
+# e.g. 'shipment.buy', duration is in seconds and error is the exception raised by the call or None
+api_call_finished = Signal(providing_args=['operation', 'duration', 'error'])
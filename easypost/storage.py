@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import get_storage_class
+
+import hashlib
+import tempfile
+
+from .transport import get_session
+
+
+def get_label_storage():
+    """
+    Returns the storage label files are archived to, EASYPOST_LABEL_STORAGE or the default file storage
+    """
+    return get_storage_class(getattr(settings, 'EASYPOST_LABEL_STORAGE', None))()
+
+
+def store_label_file(chunks, format, storage=None):
+    """
+    Write a label file from an iterable of byte chunks to the label storage and return its name there
+
+    The chunks are spooled to a temporary file rather than held in memory. Files are named by the sha256 of
+    their contents, so a file which is already stored is not written again.
+    """
+    storage = storage or get_label_storage()
+    digest = hashlib.sha256()
+    with tempfile.TemporaryFile() as temp:
+        for chunk in chunks:
+            if chunk:
+                digest.update(chunk)
+                temp.write(chunk)
+
+        hexdigest = digest.hexdigest()
+        name = '{0}/{1}/{2}.{3}'.format(getattr(settings, 'EASYPOST_LABEL_STORAGE_PREFIX', 'easypost/labels'),
+                                        hexdigest[:2], hexdigest, format)
+        if not storage.exists(name):
+            temp.seek(0)
+            name = storage.save(name, File(temp))
+    return name
+
+
+def download_label_file(url, format, storage=None):
+    """
+    Stream a label file from its EasyPost url into the label storage in chunks of
+    EASYPOST_LABEL_DOWNLOAD_CHUNK_SIZE bytes and return its name there
+
+    Label files are served from EasyPost's file host rather than the API, so like easypost.printing this does not
+    go through easypost.api.call_api() and is not rate limited.
+    """
+    response = get_session().get(url, stream=True)
+    try:
+        response.raise_for_status()
+        chunk_size = getattr(settings, 'EASYPOST_LABEL_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+        return store_label_file(response.iter_content(chunk_size), format, storage)
+    finally:
+        response.close()
@@ -1,11 +1,22 @@
 import celery
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from django.utils import six
+from django.utils.encoding import force_text
 
 import easypost
 import dateutil.parser
 
-from .models import Shipment, Label
+from .api import call_api
+from .models import (Shipment, ShipmentTrackingHistory, Label, WebhookEvent, PendingWebhookEvent,
+                     BufferedTrackerUpdate)
+from .utils import concurrent_map, chunked, bulk_update
 
+from collections import defaultdict
+
+import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,19 +26,261 @@ logger = logging.getLogger(__name__)
 def process_webhook_event(easypost_data):
     """
     Take the JSON from an EasyPost webhook POST and process it.
+
+    Each event is only processed once, repeated deliveries of an event which has been processed are ignored.
+    If EASYPOST_TRACKER_COALESCE_WINDOW is set, tracker updates are coalesced, see coalesce_tracker_update().
+    """
+    new_event = parse_webhook_event(easypost_data)
+    if new_event is None:
+        return
+
+    with transaction.atomic():
+        if new_event.get('id') and not WebhookEvent.objects.claim(new_event.id):
+            return
+
+        if new_event.get('description') == 'tracker.updated':
+            # Currently only handling tracking updates.
+            if getattr(settings, 'EASYPOST_TRACKER_COALESCE_WINDOW', 0):
+                coalesce_tracker_update(new_event.result)
+            else:
+                apply_tracker_update(new_event.result)
+
+
+def parse_webhook_event(easypost_data):
+    """
+    Returns the EasyPost Event in the JSON from a webhook POST, or None if it is not a valid event
+
+    Invalid events are logged and dropped, so that one bad payload can not stop the others from being processed.
+    Tracker updates are checked to have everything apply_tracker_updates() reads.
+    """
+    try:
+        values = json.loads(force_text(easypost_data))
+        if not isinstance(values, dict):
+            raise ValueError("Not a JSON object")
+        if not isinstance(values.get('id', ''), six.string_types):
+            raise ValueError("Invalid event id")
+
+        if values.get('description') == 'tracker.updated':
+            validate_tracker(values.get('result'))
+        event = easypost.convert_to_easypost_object(values, settings.EASYPOST_API_KEY)
+    except Exception as e:
+        logger.warning('Dropping invalid EasyPost webhook event: %s %r', e, easypost_data[:1000])
+        return None
+    return event
+
+
+def validate_tracker(values):
+    """
+    Raise ValueError unless the JSON values of an EasyPost Tracker have everything apply_tracker_updates() reads,
+    with values which fit the fields they are stored in
+    """
+    if not isinstance(values, dict):
+        raise ValueError("Tracker is not a JSON object")
+    if not values.get('shipment_id') or not isinstance(values['shipment_id'], six.string_types):
+        raise ValueError("Invalid tracker shipment_id")
+    if not isinstance(values.get('updated_at') or '', six.string_types):
+        raise ValueError("Invalid tracker updated_at")
+    if 'tracking_code' not in values or 'status' not in values:
+        raise ValueError("Tracker has no tracking_code or status")
+    validate_string(values['tracking_code'], Shipment, 'tracking_code')
+    validate_string(values['status'], Shipment, 'tracking_status')
+    if not isinstance(values.get('tracking_details'), list):
+        raise ValueError("Invalid tracker tracking_details")
+    for history in values['tracking_details']:
+        if not isinstance(history, dict) or not isinstance(history.get('datetime'), six.string_types):
+            raise ValueError("Invalid tracking detail")
+        validate_string(history.get('status'), ShipmentTrackingHistory, 'status')
+        validate_string(history.get('message'), ShipmentTrackingHistory, 'message')
+        dateutil.parser.parse(history['datetime'])
+
+
+def validate_string(value, model, field_name):
+    """
+    Raise ValueError unless value is a string which can be stored in the field, or None if the field is nullable
+    """
+    field = model._meta.get_field(field_name)
+    if value is None and field.null:
+        return
+    if not isinstance(value, six.string_types):
+        raise ValueError("Invalid {0}".format(field_name))
+    if field.max_length and len(value) > field.max_length:
+        raise ValueError("{0} is longer than {1} characters".format(field_name, field.max_length))
+
+
+def apply_tracker_update(tracker):
+    """
+    Update the tracking code, status and history of the shipment for an EasyPost Tracker
+    """
+    apply_tracker_updates([tracker])
+
+
+def apply_tracker_updates(trackers):
+    """
+    Update the tracking code, status and history of the shipments for many EasyPost Trackers
+
+    The shipments are found with at most one query, their tracking codes and statuses are saved with batched
+    UPDATEs (see utils.bulk_update()) and all of their new tracking histories are inserted at once, see
+    ShipmentTrackingHistoryManager.add_tracking_details()
+    """
+    trackers = list(trackers)
+    shipment_ids = Shipment.objects.get_ids_by_easypost_id(tracker.shipment_id for tracker in trackers)
+
+    shipments = {}
+    details = []
+    for tracker in trackers:
+        shipment_id = shipment_ids.get(tracker.shipment_id)
+        if shipment_id is None:
+            logger.warning('Tracker update for unknown shipment %s', tracker.shipment_id)
+            continue
+
+        shipments[shipment_id] = Shipment(id=shipment_id, tracking_code=tracker.tracking_code,
+                                          tracking_status=tracker.status)
+        details.extend((shipment_id, history.status, history.message, dateutil.parser.parse(history.datetime))
+                       for history in tracker.tracking_details)
+
+    # a shipment with a tracker update is not due for polling, see ShipmentManager.due_for_tracking()
+    bulk_update(Shipment.objects.all(), shipments.values(), ['tracking_code', 'tracking_status'],
+                tracking_checked_date=timezone.now())
+    ShipmentTrackingHistory.objects.add_tracking_details(details)
+
+
+def apply_valid_tracker_updates(trackers):
+    """
+    Like apply_tracker_updates(), but a tracker which can not be applied is logged and dropped rather than
+    failing all of them
+
+    The trackers are applied together in a savepoint. If that fails they are applied one at a time, each in its own
+    savepoint. Returns the list of trackers which were dropped.
+    """
+    trackers = list(trackers)
+    try:
+        with transaction.atomic():
+            apply_tracker_updates(trackers)
+        return []
+    except Exception:
+        logger.warning('Applying %d tracker updates together failed, applying them one at a time', len(trackers))
+
+    dropped = []
+    for tracker in trackers:
+        try:
+            with transaction.atomic():
+                apply_tracker_update(tracker)
+        except Exception:
+            logger.exception('Dropping tracker update for shipment %s', tracker.get('shipment_id'))
+            dropped.append(tracker)
+    return dropped
+
+
+def is_newer_tracker(tracker, other_tracker):
+    """
+    Whether tracker was updated after other_tracker, either of which can be a Tracker or its to_dict()
+    """
+    if not tracker.get('updated_at') or not other_tracker.get('updated_at'):
+        return True
+    return tracker.get('updated_at') >= other_tracker.get('updated_at')
+
+
+def coalesce_tracker_update(tracker):
+    """
+    Buffer a tracker update and apply only the newest update for each shipment once per
+    EASYPOST_TRACKER_COALESCE_WINDOW seconds.
+
+    Carriers often send bursts of updates for a shipment within seconds and every update carries the
+    full tracking history, so applying only the newest one leaves the shipment in the same state.
+    The update is buffered in the database, see BufferedTrackerUpdateManager.buffer(), in the same transaction
+    as the webhook event is claimed.
+    """
+    window = getattr(settings, 'EASYPOST_TRACKER_COALESCE_WINDOW', 0)
+    updated_at = dateutil.parser.parse(tracker.updated_at) if tracker.get('updated_at') else None
+
+    if BufferedTrackerUpdate.objects.buffer(tracker.shipment_id, json.dumps(tracker.to_dict()), updated_at,
+                                            window + 60):
+        process_coalesced_tracker_update.apply_async(args=[tracker.shipment_id], countdown=window)
+
+
+@celery.task(ignore_result=True, default_retry_delay=10, max_retried=20)
+def process_coalesced_tracker_update(easypost_shipment_id):
+    """
+    Apply the newest tracker update buffered by coalesce_tracker_update() for a shipment
+    """
+    with transaction.atomic():
+        update = BufferedTrackerUpdate.objects.select_for_update().filter(easypost_shipment_id=easypost_shipment_id,
+                                                                          pending=True).first()
+        if update is None:
+            return
+
+        apply_tracker_update(easypost.convert_to_easypost_object(json.loads(update.payload),
+                                                                 settings.EASYPOST_API_KEY))
+        update.pending = False
+        update.save(update_fields=['pending', 'modified_date'])
+
+
+WEBHOOK_EVENT_BATCH_SCHEDULED_KEY = 'easypost:webhook_event_batch_scheduled'
+
+
+def queue_webhook_event(easypost_data):
+    """
+    Buffer the JSON from an EasyPost webhook POST to be processed by process_webhook_event_batch(), which will
+    run within EASYPOST_WEBHOOK_FLUSH_INTERVAL seconds
+    """
+    PendingWebhookEvent.objects.create(payload=force_text(easypost_data))
+    schedule_webhook_event_batch(getattr(settings, 'EASYPOST_WEBHOOK_FLUSH_INTERVAL', 5))
+
+
+def schedule_webhook_event_batch(countdown):
+    cache = caches[getattr(settings, 'EASYPOST_CACHE', 'default')]
+    if cache.add(WEBHOOK_EVENT_BATCH_SCHEDULED_KEY, True, countdown + 60):
+        process_webhook_event_batch.apply_async(countdown=countdown)
+
+
+@celery.task(ignore_result=True, default_retry_delay=10, max_retried=20)
+def process_webhook_event_batch():
+    """
+    Process up to EASYPOST_WEBHOOK_BATCH_SIZE webhook events buffered by queue_webhook_event() at once.
+
+    Repeated deliveries are dropped, only the newest tracker update for each shipment is applied and all of
+    the updates are written together, see apply_tracker_updates(). Invalid events, and updates which can not be
+    applied, are logged and dropped so that they do not hold up the queue, see apply_valid_tracker_updates().
+    Runs again straight away while there are more events waiting.
+    """
+    batch_size = getattr(settings, 'EASYPOST_WEBHOOK_BATCH_SIZE', 500)
+    caches[getattr(settings, 'EASYPOST_CACHE', 'default')].delete(WEBHOOK_EVENT_BATCH_SCHEDULED_KEY)
+
+    with transaction.atomic():
+        pending = list(PendingWebhookEvent.objects.select_for_update().order_by('id')[:batch_size])
+        if not pending:
+            return
+        PendingWebhookEvent.objects.filter(id__in=[event.id for event in pending]).delete()
+
+        events = [event for event in (parse_webhook_event(event.payload) for event in pending) if event is not None]
+        claimed = WebhookEvent.objects.claim_many(event.id for event in events if event.get('id'))
+
+        trackers = {}
+        for event in events:
+            if event.get('id') and event.id not in claimed:
+                continue
+            claimed.discard(event.get('id'))
+
+            if event.get('description') == 'tracker.updated':
+                tracker = event.result
+                if tracker.shipment_id not in trackers or is_newer_tracker(tracker, trackers[tracker.shipment_id]):
+                    trackers[tracker.shipment_id] = tracker
+
+        apply_valid_tracker_updates(trackers.values())
+
+    if len(pending) == batch_size:
+        schedule_webhook_event_batch(0)
+
+
+@celery.task(ignore_result=True)
+def purge_webhook_events():
+    """
+    Forget processed webhook events, and applied coalesced tracker updates, older than EASYPOST_WEBHOOK_EVENT_TTL
+    seconds, after which EasyPost will no longer be retrying them
     """
-    new_event = easypost.Event()
-    new_event = new_event.receive(easypost_data)
-    if new_event.description == 'tracker.updated':
-        # Currently only handling tracking updates.
-        easypost_shipment_id = new_event.result.shipment_id
-        shipment = Shipment.objects.get(easypost_id=easypost_shipment_id)
-        shipment.tracking_code = new_event.result.tracking_code
-        shipment.tracking_status = new_event.result.status
-        shipment.save(update_fields=['tracking_code', 'tracking_status'])
-        for history in new_event.result.tracking_details:
-            event_date = dateutil.parser.parse(history.datetime)
-            shipment.update_tracking_history(status=history.status, message=history.message, update_time=event_date)
+    ttl = getattr(settings, 'EASYPOST_WEBHOOK_EVENT_TTL', 7 * 24 * 60 * 60)
+    WebhookEvent.objects.purge(ttl)
+    BufferedTrackerUpdate.objects.purge(ttl)
 
 
 @celery.task(ignore_result=True, default_retry_delay=10, max_retried=20)
@@ -38,29 +291,117 @@ def get_additional_label_formats(label_id):
     By default EasyPost only generates a png label immediately and then asynchronously generates a pdf.
     If the pdf is needed immediately or the zpl is needed at all, then they must be specifically requested.
     This process can be slow, so just automatically request all of them asynchronously.
+    If EASYPOST_ARCHIVE_LABEL_FILES is set, the files are then also downloaded into the label storage.
     """
-    label = Label.objects.get(id=label_id)
-    for format in Label.LABEL_FORMATS:
-        try:
-            label.request_label_file(format=format)
-        except Exception, e:
-            logger.exception(e)
+    label = Label.objects.select_related('shipment').get(id=label_id)
+    label.request_label_files()
+    if getattr(settings, 'EASYPOST_ARCHIVE_LABEL_FILES', False):
+        label.archive_files()
+
 
-    label.save()
+@celery.task(ignore_result=True, default_retry_delay=10, max_retried=20)
+def archive_label_files(label_ids):
+    """
+    Download the files of the labels into the label storage so they can be printed without going to EasyPost,
+    see LabelManager.archive_files()
+    """
+    Label.objects.archive_files(Label.objects.filter(id__in=label_ids))
 
 
 @celery.task(ignore_result=True, default_retry_delay=10, max_retried=20)
 def update_refund_statuses():
     """
     Poll the EasyPost API for refund statuses on shipments where a refund has been requested
+
+    Shipments are read in chunks of EASYPOST_REFUND_POLL_CHUNK_SIZE and each chunk is retrieved from EasyPost
+    on up to EASYPOST_REFUND_POLL_WORKERS threads. Only shipments whose refund status changed are written,
+    with one update per new status.
+
+    Returns a dict with the number of shipments checked, changed and failed.
     """
+    chunk_size = getattr(settings, 'EASYPOST_REFUND_POLL_CHUNK_SIZE', 100)
+    workers = getattr(settings, 'EASYPOST_REFUND_POLL_WORKERS', 8)
+    counts = {'checked': 0, 'changed': 0, 'failed': 0}
 
-    shipments = Shipment.objects.filter(refund_status=Shipment.RefundStatus.SUBMITTED)
-    for shipment in shipments:
-        try:
-            easypost_shipment = easypost.Shipment.retrieve(id=shipment.easypost_id, api_key=settings.EASYPOST_API_KEY)
-        except Exception, e:
-            logger.exception(e)
-        else:
-            shipment.refund_status = easypost_shipment.refund_status
-            shipment.save(update_fields=['refund_status'])
+    def retrieve(shipment):
+        return call_api('shipment.retrieve', easypost.Shipment.retrieve, shipment.easypost_id,
+                        api_key=settings.EASYPOST_API_KEY)
+
+    shipments = Shipment.objects.filter(refund_status=Shipment.RefundStatus.SUBMITTED).only(
+        'id', 'easypost_id', 'refund_status')
+    for chunk in chunked(shipments.iterator(), chunk_size):
+        changed = defaultdict(list)
+        for shipment, easypost_shipment, error in concurrent_map(retrieve, chunk, workers):
+            counts['checked'] += 1
+            if error is not None:
+                counts['failed'] += 1
+                continue
+
+            refund_status = easypost_shipment.refund_status or Shipment.RefundStatus.NONE
+            if refund_status != shipment.refund_status:
+                changed[refund_status].append(shipment.id)
+
+        for refund_status, shipment_ids in changed.items():
+            Shipment.objects.filter(id__in=shipment_ids).update(refund_status=refund_status)
+            counts['changed'] += len(shipment_ids)
+
+    logger.info('Checked %(checked)d refunds, %(changed)d changed, %(failed)d failed', counts)
+    return counts
+
+
+@celery.task(ignore_result=True)
+def poll_tracking():
+    """
+    Check the tracking of shipments which are due on EasyPost, to catch up on any missed webhooks
+
+    Up to EASYPOST_TRACKING_POLL_LIMIT shipments are checked per run, in the order of
+    ShipmentManager.due_for_tracking(), in chunks of EASYPOST_TRACKING_POLL_CHUNK_SIZE retrieved on up to
+    EASYPOST_TRACKING_POLL_WORKERS threads. Their trackers are validated and applied like webhook tracker updates,
+    see apply_valid_tracker_updates(). A shipment which can not be retrieved or whose tracker is invalid or can not
+    be applied is logged and still marked as checked, so it does not hold up the rest. Schedule this more often
+    than the shortest poll interval.
+
+    Returns a dict with the number of shipments checked, updated and failed.
+    """
+    limit = getattr(settings, 'EASYPOST_TRACKING_POLL_LIMIT', 1000)
+    chunk_size = getattr(settings, 'EASYPOST_TRACKING_POLL_CHUNK_SIZE', 100)
+    workers = getattr(settings, 'EASYPOST_TRACKING_POLL_WORKERS', 8)
+    counts = {'checked': 0, 'updated': 0, 'failed': 0}
+
+    def retrieve(shipment):
+        return call_api('shipment.retrieve', easypost.Shipment.retrieve, shipment.easypost_id,
+                        api_key=settings.EASYPOST_API_KEY)
+
+    shipments = list(Shipment.objects.due_for_tracking().only('id', 'easypost_id')[:limit])
+    for chunk in chunked(shipments, chunk_size):
+        trackers = []
+        for shipment, easypost_shipment, error in concurrent_map(retrieve, chunk, workers):
+            counts['checked'] += 1
+            if error is not None:
+                counts['failed'] += 1
+                continue
+
+            tracker = easypost_shipment.get('tracker')
+            if not tracker:
+                continue
+            if not tracker.get('shipment_id'):
+                tracker.shipment_id = easypost_shipment.id
+            try:
+                validate_tracker(tracker.to_dict())
+            except Exception as e:
+                logger.warning('Invalid tracker for shipment %s: %s', easypost_shipment.id, e)
+                counts['failed'] += 1
+                continue
+            trackers.append(tracker)
+
+        with transaction.atomic():
+            dropped = apply_valid_tracker_updates(trackers)
+            # failed shipments are also marked as checked so they do not hold up the rest, they are retried
+            # after their interval
+            Shipment.objects.filter(id__in=[shipment.id for shipment in chunk]).update(
+                tracking_checked_date=timezone.now())
+        counts['updated'] += len(trackers) - len(dropped)
+        counts['failed'] += len(dropped)
+
+    logger.info('Checked tracking of %(checked)d shipments, %(updated)d updated, %(failed)d failed', counts)
+    return counts
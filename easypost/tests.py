@@ -1,14 +1,342 @@
 from django.test import TestCase
 from django.core.urlresolvers import reverse
-from django.test.utils import override_settings
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.core.files.storage import FileSystemStorage
 from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.utils import six
 
 import json
+import datetime
+import requests
+import shutil
+import tempfile
 
-from easypost.models import Shipment
+from decimal import Decimal
+
+from django.utils import timezone
+
+from easypost.cache import shipment_cache
+from easypost.models import Address, Parcel, Shipment, ShipmentTrackingHistory, Label, AddressVerification, ShipmentRate, WebhookEvent, PendingWebhookEvent
+from easypost import models as easypost_models, tasks
+from easypost.api import call_api
+from easypost.ratelimit import RateLimiter, rate_limiter
+from easypost.metrics import api_metrics
+from easypost import transport
+from easypost.transport import configure_transport, get_session
+from easypost.utils import concurrent_map, concurrent_imap, chunked, bulk_update
+from easypost.storage import store_label_file
+from easypost.printing import iter_print_file
 from .factories import UserFactory, AddressFactory, ParcelFactory, ShipmentFactory, LabelFactory
 
 
+class FakeEasypostObject(dict):
+    """
+    Stands in for the easypost library's objects, which are dicts with attribute access
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return json.loads(json.dumps(self))
+
+    @classmethod
+    def convert(cls, values, api_key=None):
+        if isinstance(values, dict):
+            return cls((key, cls.convert(value)) for key, value in values.items())
+        if isinstance(values, list):
+            return [cls.convert(value) for value in values]
+        return values
+
+
+class FakeEasypost(object):
+    """
+    Stands in for the easypost library, see FakeEasypostMixin
+    """
+    convert_to_easypost_object = staticmethod(FakeEasypostObject.convert)
+
+    class Shipment(object):
+        # easypost id to the values of the shipment retrieve() returns, or an exception for it to raise
+        shipments = {}
+        # the values of the shipment create() returns
+        created = {}
+        # the easypost ids retrieve() was called with
+        retrieved = []
+
+        @classmethod
+        def retrieve(cls, easypost_id, api_key=None):
+            cls.retrieved.append(easypost_id)
+            values = cls.shipments[easypost_id]
+            if isinstance(values, Exception):
+                raise values
+            return FakeEasypostObject.convert(dict(values, id=easypost_id))
+
+        def __init__(self, easypost_id=None, api_key=None):
+            self.id = easypost_id
+
+        @classmethod
+        def create(cls, **params):
+            return FakeEasypostObject.convert(cls.created)
+
+        def buy(self, rate):
+            self.postage_label = FakeEasypostObject.convert({'label_url': 'https://example.com/label.png'})
+            return self
+
+
+class FakeEasypostMixin(object):
+    """
+    Replaces the easypost library in easypost.models and easypost.tasks with FakeEasypost during each test
+    """
+
+    def setUp(self):
+        super(FakeEasypostMixin, self).setUp()
+        FakeEasypost.Shipment.shipments = {}
+        FakeEasypost.Shipment.created = {}
+        FakeEasypost.Shipment.retrieved = []
+        self.easypost = easypost_models.easypost, tasks.easypost
+        easypost_models.easypost = tasks.easypost = FakeEasypost
+
+    def tearDown(self):
+        easypost_models.easypost, tasks.easypost = self.easypost
+        super(FakeEasypostMixin, self).tearDown()
+
+
+def make_tracker(easypost_shipment_id, status, updated_at):
+    return {
+        'object': 'Tracker',
+        'shipment_id': easypost_shipment_id,
+        'tracking_code': '9499907123456123456781',
+        'status': status,
+        'updated_at': updated_at,
+        'tracking_details': [{'object': 'TrackingDetail', 'status': status, 'message': status,
+                              'datetime': updated_at}],
+    }
+
+
+class UtilsTest(TestCase):
+
+    def test_concurrent_map(self):
+        def invert(n):
+            return 1.0 / n
+
+        results = concurrent_map(invert, [1, 0, 4], workers=2)
+        self.assertEqual([(item, result) for item, result, error in results], [(1, 1.0), (0, None), (4, 0.25)])
+        self.assertTrue(isinstance(results[1][2], ZeroDivisionError))
+
+    def test_concurrent_imap(self):
+        def invert(n):
+            return 1.0 / n
+
+        results = list(concurrent_imap(invert, iter([1, 0, 4, 5]), workers=2))
+        self.assertEqual([(item, result) for item, result, error in results],
+                         [(1, 1.0), (0, None), (4, 0.25), (5, 0.2)])
+        self.assertTrue(isinstance(results[1][2], ZeroDivisionError))
+
+    def test_concurrent_imap_cleanup(self):
+        cleaned = []
+        results = concurrent_imap(lambda n: n * 2, iter(range(10)), workers=3, cleanup=cleaned.append)
+        self.assertEqual(next(results), (0, 0, None))
+        results.close()
+        # the results fetched ahead which were never consumed
+        self.assertEqual(cleaned, [2, 4])
+
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_bulk_update(self):
+        addresses = [AddressFactory.create(city='Austin'), AddressFactory.create(city='Austin'),
+                     AddressFactory.create(city='Austin')]
+        for address, city in zip(addresses, ['Dallas', 'Houston', 'El Paso']):
+            address.city = city
+
+        with self.assertNumQueries(2):
+            bulk_update(Address.objects.all(), addresses, ['city'], batch_size=2, verified_address=True)
+        cities = Address.objects.filter(verified_address=True).order_by('id').values_list('city', flat=True)
+        self.assertEqual(list(cities), ['Dallas', 'Houston', 'El Paso'])
+
+
+class StorageTest(TestCase):
+
+    def setUp(self):
+        self.storage = FileSystemStorage(location=tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.storage.location)
+
+    def test_store_label_file(self):
+        name = store_label_file([b'^XA', b'^XZ'], 'zpl', storage=self.storage)
+        self.assertTrue(name.endswith('.zpl'))
+        self.assertEqual(self.storage.open(name).read(), b'^XA^XZ')
+
+        # the same contents are stored once under the same name
+        self.assertEqual(store_label_file([b'^XA^XZ'], 'zpl', storage=self.storage), name)
+        self.assertEqual(len(self.storage.listdir(name.rsplit('/', 1)[0])[1]), 1)
+        self.assertNotEqual(store_label_file([b'^XA^FO^XZ'], 'zpl', storage=self.storage), name)
+
+
+class PrintingTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_iter_print_file(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            storage = FileSystemStorage()
+            labels = [Label(label_zpl_file=store_label_file([b'^XA^FO1^XZ'], 'zpl', storage=storage)),
+                      Label(label_zpl_file=store_label_file([b'^XA^FO2^XZ\n'], 'zpl', storage=storage)),
+                      Label(label_zpl_file=store_label_file([b'^XA^FO3^XZ'], 'zpl', storage=storage))]
+
+            self.assertEqual(b''.join(iter_print_file(labels, 'zpl', workers=2)),
+                             b'^XA^FO1^XZ\n^XA^FO2^XZ\n^XA^FO3^XZ\n')
+            with self.assertRaises(ValueError):
+                list(iter_print_file(labels, 'png'))
+
+
+class TransportTest(TestCase):
+
+    def tearDown(self):
+        configure_transport()
+
+    @override_settings(EASYPOST_HTTP_POOL_MAXSIZE=32, EASYPOST_HTTP_CONNECT_TIMEOUT=3)
+    def test_configure_transport(self):
+        session = configure_transport()
+
+        self.assertIs(get_session(), session)
+        self.assertEqual(session.connect_timeout, 3)
+        self.assertEqual(session.get_adapter('https://api.easypost.com/v2')._pool_maxsize, 32)
+
+    @override_settings(EASYPOST_HTTP_CONNECT_TIMEOUT=3, EASYPOST_HTTP_READ_TIMEOUT=20)
+    def test_easypost_requests_use_session(self):
+        class RecordingAdapter(requests.adapters.BaseAdapter):
+            """
+            Answers every request with an EasyPost address instead of sending it
+            """
+            sent = []
+
+            def send(self, request, **kwargs):
+                self.sent.append((request, kwargs))
+                response = requests.Response()
+                response.status_code = 200
+                response.headers['Content-Type'] = 'application/json'
+                response._content = json.dumps({'object': 'Address', 'id': 'adr_pooled'}).encode('utf-8')
+                response.url = request.url
+                response.request = request
+                return response
+
+            def close(self):
+                pass
+
+        session = configure_transport()
+        adapter = RecordingAdapter()
+        session.mount('https://', adapter)
+
+        address = transport.easypost.Address.retrieve('adr_pooled', api_key=settings.EASYPOST_API_KEY)
+
+        self.assertEqual(address.id, 'adr_pooled')
+        self.assertEqual(len(adapter.sent), 1)
+        self.assertIn('adr_pooled', adapter.sent[0][0].url)
+        # the library asks for a 60 second timeout, EasyPostSession.request() replaced it
+        self.assertEqual(adapter.sent[0][1]['timeout'], (3, 20))
+
+
+class ApiMetricsTest(TestCase):
+
+    def setUp(self):
+        api_metrics.reset()
+
+    def test_call_api(self):
+        self.assertEqual(call_api('test.add', lambda a, b: a + b, 1, b=2), 3)
+        self.assertRaises(ZeroDivisionError, call_api, 'test.divide', lambda a, b: a / b, 1, 0)
+
+        metrics = api_metrics.snapshot()
+        self.assertEqual(metrics['test.add']['calls'], 1)
+        self.assertEqual(metrics['test.add']['errors'], {})
+        self.assertEqual(sum(count for bucket, count in metrics['test.add']['latencies']), 1)
+        self.assertEqual(metrics['test.divide']['errors'], {'ZeroDivisionError': 1})
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(EASYPOST_RATE_LIMITS={'default': 2, 'shipment': 5, 'shipment.create': 1, 'shipment.label': None})
+class RateLimiterTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.clock = FakeClock(1000.0)
+        self.limiter = RateLimiter(sleep=self.clock.sleep, clock=self.clock)
+
+    def test_get_bucket(self):
+        self.assertEqual(self.limiter.get_bucket('shipment.create'), ('shipment.create', 1))
+        self.assertEqual(self.limiter.get_bucket('shipment.buy'), ('shipment', 5))
+        self.assertEqual(self.limiter.get_bucket('address.verify'), ('default', 2))
+        self.assertEqual(self.limiter.get_bucket('shipment.label'), ('shipment.label', None))
+
+    def test_acquire(self):
+        for i in range(3):
+            self.limiter.acquire('address.verify')
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertEqual(int(self.clock.now), 1001)
+
+        for i in range(10):
+            self.limiter.acquire('shipment.label')
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_backoff(self):
+        self.limiter.backoff('address.verify', 0, retry_after=30)
+        self.limiter.acquire('address.verify')
+        self.assertGreaterEqual(self.clock.now, 1030.0)
+
+        # the limit is halved and only one call is allowed in the next second
+        self.limiter.acquire('address.verify')
+        self.assertEqual(len(self.clock.sleeps), 2)
+
+    def test_call_api_retries(self):
+        class RateLimited(Exception):
+            http_status = 429
+
+        calls = []
+
+        def create():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RateLimited()
+            return 'created'
+
+        sleep, clock = rate_limiter.sleep, rate_limiter.clock
+        rate_limiter.sleep, rate_limiter.clock = self.clock.sleep, self.clock
+        try:
+            self.assertEqual(call_api('test.create', create), 'created')
+            self.assertEqual(len(calls), 3)
+            # backed off after each rate limited call
+            self.assertGreaterEqual(len(self.clock.sleeps), 2)
+            with self.settings(EASYPOST_RATE_LIMIT_RETRIES=0):
+                calls[:] = []
+                self.assertRaises(RateLimited, call_api, 'test.create', create)
+        finally:
+            rate_limiter.sleep, rate_limiter.clock = sleep, clock
+
+
 class AddressTest(TestCase):
 
     def setUp(self):
@@ -27,6 +355,56 @@ class AddressTest(TestCase):
         self.address.verify()
         self.assertTrue(self.address.verified_address)
 
+    def test_fingerprint_is_normalized(self):
+        other_address = AddressFactory.build(
+            street1='98  san jacinto BLVD',
+            city='AUSTIN ',
+            state='tx',
+            zip_code='78701',
+            country='us'
+        )
+        self.assertEqual(self.address.get_fingerprint(), other_address.get_fingerprint())
+
+    def test_get_easypost_reference(self):
+        self.assertEqual(self.address.get_easypost_reference()['street1'], '98 San Jacinto Blvd')
+
+        self.address.set_easypost_id('adr_warehouse')
+        self.assertEqual(self.address.get_easypost_reference(), {'id': 'adr_warehouse'})
+
+        self.address.street2 = 'Suite 100'
+        self.assertEqual(self.address.get_easypost_reference()['street2'], 'Suite 100')
+
+    def test_verify_address_from_verification(self):
+        AddressVerification.objects.create(
+            fingerprint=self.address.get_fingerprint(),
+            street1='98 SAN JACINTO BLVD',
+            city='AUSTIN',
+            state='TX',
+            zip_code='78701-4082',
+            country='US'
+        )
+        self.address.verify()
+        self.assertTrue(self.address.verified_address)
+        self.assertEqual(self.address.zip_code, '78701-4082')
+
+    def test_verify_many_from_verifications(self):
+        addresses = [self.address, AddressFactory.create(street1=self.address.street1.upper(),
+                                                         city=self.address.city,
+                                                         state=self.address.state,
+                                                         zip_code=self.address.zip_code)]
+        AddressVerification.objects.create(
+            fingerprint=self.address.get_fingerprint(),
+            street1='98 SAN JACINTO BLVD',
+            city='AUSTIN',
+            state='TX',
+            zip_code='78701-4082',
+            country='US'
+        )
+        results = Address.objects.verify_many(addresses)
+
+        self.assertEqual(results, {addresses[0].id: None, addresses[1].id: None})
+        self.assertEqual(Address.objects.filter(verified_address=True, zip_code='78701-4082').count(), 2)
+
 
 class ParcelTest(TestCase):
 
@@ -37,6 +415,25 @@ class ParcelTest(TestCase):
         self.parcel.create_on_easypost()
         self.assertTrue(self.parcel.easypost_id is not None)
 
+    def test_create_on_easypost_reuses_parcel(self):
+        self.parcel.create_on_easypost()
+        other_parcel = ParcelFactory.create(weight=self.parcel.weight)
+        other_parcel.create_on_easypost()
+        self.assertEqual(other_parcel.easypost_id, self.parcel.easypost_id)
+
+
+class ParcelSignatureTest(TestCase):
+
+    def test_get_signature(self):
+        parcel = Parcel(predefined_package='', length=10, width=8, height=4.5, weight=12.04)
+        self.assertEqual(parcel.get_signature(), '10.0x8.0x4.5|12.0')
+        # the same box with float dimensions, as it is after being loaded from the database
+        parcel = Parcel(predefined_package='', length=10.0, width=8.0, height=4.5, weight=12.0)
+        self.assertEqual(parcel.get_signature(), '10.0x8.0x4.5|12.0')
+
+        parcel = Parcel(predefined_package=Parcel.USPSPredefinedPackage.FLAT_RATE_ENVELOPE, weight=3)
+        self.assertEqual(parcel.get_signature(), 'FlatRateEnvelope|3.0')
+
 
 class ShipmentTest(TestCase):
 
@@ -76,6 +473,17 @@ class ShipmentTest(TestCase):
     def test_create_on_easypost(self):
         self.assertTrue(self.shipment.easypost_id is not None)
 
+    def test_create_many_on_easypost(self):
+        shipment = ShipmentFactory.create(
+            to_address=self.to_address,
+            from_address=self.from_address,
+            created_by=self.user
+        )
+        results = Shipment.objects.create_many_on_easypost([shipment], [self.easypost_parcel])
+
+        self.assertEqual(results, {shipment.id: None})
+        self.assertTrue(Shipment.objects.get(id=shipment.id).easypost_id is not None)
+
     def test_get_easypost_shipment(self):
         self.assertEqual(self.easypost_shipment.id, self.shipment.get_easypost_shipment().id)
 
@@ -92,12 +500,306 @@ class ShipmentTest(TestCase):
         self.assertTrue(self.shipment.service is not None)
         self.assertTrue(self.shipment.carrier is not None)
 
+    def test_buy_label_from_stored_rates(self):
+        easypost_label = self.shipment.buy_label()
+
+        self.assertTrue(easypost_label.label_url)
+        self.assertEqual(self.shipment.rate, self.shipment.get_lowest_stored_rate().rate)
+
     def test_refund(self):
         self.shipment.buy_label(shipment=self.easypost_shipment)
         self.shipment.refund()
         self.assertEqual(self.shipment.refund_status, Shipment.RefundStatus.SUBMITTED)
 
 
+class ShipmentTrackingHistoryTest(TestCase):
+
+    def setUp(self):
+        self.shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                from_address=AddressFactory.create())
+        update_time = timezone.now()
+        self.histories = [
+            ('pre_transit', 'Electronic Shipping Info Received', update_time),
+            ('in_transit', 'Arrived at USPS Origin Facility', update_time + datetime.timedelta(hours=6)),
+        ]
+
+    def test_update_tracking_histories(self):
+        self.assertEqual(len(self.shipment.update_tracking_histories(self.histories)), 2)
+        self.assertEqual(self.shipment.shipmenttrackinghistory_set.count(), 2)
+
+    def test_update_tracking_histories_only_adds_new(self):
+        self.shipment.update_tracking_histories(self.histories[:1])
+        new_histories = self.shipment.update_tracking_histories(self.histories)
+
+        self.assertEqual([history.status for history in new_histories], ['in_transit'])
+        self.assertEqual(self.shipment.shipmenttrackinghistory_set.count(), 2)
+
+    def test_update_tracking_histories_latest_tracking(self):
+        self.shipment.update_tracking_histories(self.histories[1:])
+        self.shipment.update_tracking_histories(self.histories[:1])
+
+        shipment = Shipment.objects.get(id=self.shipment.id)
+        self.assertEqual(shipment.latest_tracking_status, 'in_transit')
+        self.assertEqual(shipment.latest_tracking_update_time, self.histories[1][2])
+        self.assertEqual(shipment.get_latest_tracking_update().status, 'in_transit')
+
+    def test_update_tracking_history(self):
+        for status, message, update_time in self.histories + self.histories[:1]:
+            self.shipment.update_tracking_history(status, message, update_time)
+
+        shipment = Shipment.objects.get(id=self.shipment.id)
+        self.assertEqual(shipment.shipmenttrackinghistory_set.count(), 2)
+        self.assertEqual(shipment.latest_tracking_status, 'in_transit')
+
+    def test_update_tracking_histories_long_message(self):
+        update_time = self.histories[0][2]
+        message = 'Delivered ' * 1000
+        self.shipment.update_tracking_histories([('delivered', message, update_time)])
+        # the same update time in another timezone is the same update
+        other_time = update_time.astimezone(timezone.get_fixed_timezone(-300))
+        self.assertEqual(self.shipment.update_tracking_histories([('delivered', message, other_time)]), [])
+        self.assertEqual(self.shipment.shipmenttrackinghistory_set.get().message, message)
+
+    def test_backfill_tracking_keys(self):
+        other_shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                 from_address=AddressFactory.create())
+        self.shipment.update_tracking_histories(self.histories[:1])
+        other_shipment.update_tracking_histories(self.histories[:1])
+        # histories stored before tracking_key was added, one of them the same update as a stored history
+        ShipmentTrackingHistory.objects.bulk_create([
+            ShipmentTrackingHistory(shipment=shipment, tracking_key='', status=status, message=message,
+                                    update_time=update_time)
+            for shipment, (status, message, update_time) in [(self.shipment, self.histories[1]),
+                                                             (other_shipment, self.histories[0])]])
+
+        call_command('backfill_tracking_keys', batch_size=1, stdout=six.StringIO())
+
+        self.assertFalse(ShipmentTrackingHistory.objects.filter(tracking_key='').exists())
+        self.assertEqual(other_shipment.shipmenttrackinghistory_set.count(), 1)
+        self.assertEqual(self.shipment.update_tracking_histories(self.histories), [])
+        self.assertEqual(self.shipment.shipmenttrackinghistory_set.count(), 2)
+
+    def test_update_tracking_histories_query_count(self):
+        self.shipment.update_tracking_histories(self.histories[:1])
+        with self.assertNumQueries(0):
+            self.shipment.update_tracking_histories([])
+        with self.assertNumQueries(1):
+            self.shipment.update_tracking_histories(self.histories[:1])
+
+
+class ShipmentRateTest(FakeEasypostMixin, TestCase):
+
+    class FakeEasypostRate(object):
+
+        def __init__(self, id, rate):
+            self.id = id
+            self.rate = rate
+            self.carrier = 'USPS'
+            self.service = 'Priority'
+
+    def setUp(self):
+        super(ShipmentRateTest, self).setUp()
+        self.shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                from_address=AddressFactory.create(),
+                                                easypost_id='shp_rated')
+
+    def test_store_rates(self):
+        self.shipment.store_rates([self.FakeEasypostRate('rate_1', '5.95'), self.FakeEasypostRate('rate_2', '7.10')])
+        self.shipment.store_rates([self.FakeEasypostRate('rate_3', '6.25')])
+
+        self.assertTrue(self.shipment.has_current_rates())
+        self.assertEqual(list(self.shipment.rates.values_list('easypost_id', flat=True)), ['rate_3'])
+
+    @override_settings(EASYPOST_RATE_SNAPSHOT_TTL=60)
+    def test_has_current_rates(self):
+        self.assertFalse(self.shipment.has_current_rates())
+        self.shipment.rates_date = timezone.now() - datetime.timedelta(seconds=120)
+        self.assertFalse(self.shipment.has_current_rates())
+
+    def test_get_lowest_stored_rate(self):
+        self.shipment.store_rates([self.FakeEasypostRate('rate_1', '7.10'), self.FakeEasypostRate('rate_2', '5.95')])
+        self.assertEqual(self.shipment.get_lowest_stored_rate().easypost_id, 'rate_2')
+        self.assertEqual(self.shipment.get_lowest_stored_rate(carriers=['usps'], services=['PRIORITY']).easypost_id,
+                         'rate_2')
+        self.assertIsNone(self.shipment.get_lowest_stored_rate(carriers=['UPS']))
+
+    def test_buy_label_from_stored_rates(self):
+        self.shipment.store_rates([self.FakeEasypostRate('rate_1', '7.10'), self.FakeEasypostRate('rate_2', '5.95')])
+        label = self.shipment.buy_label()
+
+        self.assertEqual(label.label_url, 'https://example.com/label.png')
+        self.assertEqual(self.shipment.rate, Decimal('5.95'))
+        self.assertEqual(Shipment.objects.get(id=self.shipment.id).rate, Decimal('5.95'))
+
+    def test_get_shipping_rate_unknown(self):
+        self.shipment.store_rates([self.FakeEasypostRate('rate_1', '5.95')])
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.shipment.get_shipping_rate('rate_unknown'))
+
+
+class ShipmentManagerTest(FakeEasypostMixin, TestCase):
+
+    def setUp(self):
+        super(ShipmentManagerTest, self).setUp()
+        self.shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                from_address=AddressFactory.create(),
+                                                easypost_id='shp_indexed')
+
+    def test_load_addresses(self):
+        shipment = Shipment.objects.get(id=self.shipment.id)
+        with self.assertNumQueries(1):
+            shipment.load_addresses()
+            self.assertEqual(shipment.to_address.id, self.shipment.to_address_id)
+            self.assertEqual(shipment.from_address.id, self.shipment.from_address_id)
+
+    def test_create_many_on_easypost_needs_parcels(self):
+        self.assertRaises(ValueError, Shipment.objects.create_many_on_easypost, [self.shipment], [])
+
+    def test_create_many_on_easypost_replaces_rates(self):
+        ShipmentRate.objects.create(shipment=self.shipment, easypost_id='rate_old', carrier='USPS',
+                                    service='Priority', rate='9.99')
+        FakeEasypost.Shipment.created = {
+            'id': 'shp_recreated',
+            'rates': [{'id': 'rate_new', 'carrier': 'USPS', 'service': 'Priority', 'rate': '5.95'}]
+        }
+        results = Shipment.objects.create_many_on_easypost([self.shipment], [{'weight': 10}])
+
+        self.assertEqual(results, {self.shipment.id: None})
+        self.assertEqual(Shipment.objects.get(id=self.shipment.id).easypost_id, 'shp_recreated')
+        self.assertEqual(list(self.shipment.rates.values_list('easypost_id', flat=True)), ['rate_new'])
+
+    @override_settings(EASYPOST_SHIPMENT_ID_CACHE_TIMEOUT=60)
+    def test_get_ids_by_easypost_id_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(Shipment.objects.get_ids_by_easypost_id(['shp_indexed', 'shp_unknown']),
+                             {'shp_indexed': self.shipment.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(Shipment.objects.get_ids_by_easypost_id(['shp_indexed']),
+                             {'shp_indexed': self.shipment.id})
+
+        self.shipment.delete()
+        self.assertEqual(Shipment.objects.get_ids_by_easypost_id(['shp_indexed']), {})
+
+    def test_due_for_tracking(self):
+        now = timezone.now()
+        shipments = {}
+        for status, hours_ago in [(Shipment.Status.IN_TRANSIT, 5), (Shipment.Status.PRE_TRANSIT, 5),
+                                  (Shipment.Status.PRE_TRANSIT, None), (Shipment.Status.DELIVERED, None)]:
+            shipment = Shipment.objects.create(
+                to_address=AddressFactory.create(), from_address=AddressFactory.create(), tracking_status=status,
+                tracking_checked_date=now - datetime.timedelta(hours=hours_ago) if hours_ago else None)
+            Label.objects.create(shipment=shipment)
+            shipments[status, hours_ago] = shipment.id
+
+        # self.shipment has no label
+        due = [shipments[Shipment.Status.IN_TRANSIT, 5], shipments[Shipment.Status.PRE_TRANSIT, None]]
+        self.assertEqual(sorted(Shipment.objects.due_for_tracking(now).values_list('id', flat=True)), sorted(due))
+        # shipments which were never checked come first
+        self.assertEqual(Shipment.objects.due_for_tracking(now)[0].id, shipments[Shipment.Status.PRE_TRANSIT, None])
+
+
+class PollTrackingTest(FakeEasypostMixin, TestCase):
+
+    def setUp(self):
+        super(PollTrackingTest, self).setUp()
+        self.shipments = []
+        for i, checked_date in enumerate([timezone.now() - datetime.timedelta(days=1), None]):
+            shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                               from_address=AddressFactory.create(),
+                                               easypost_id='shp_polled_{0}'.format(i),
+                                               tracking_status=Shipment.Status.PRE_TRANSIT,
+                                               tracking_checked_date=checked_date)
+            Label.objects.create(shipment=shipment)
+            self.shipments.append(shipment)
+            FakeEasypost.Shipment.shipments[shipment.easypost_id] = {
+                'tracker': make_tracker(shipment.easypost_id, 'in_transit', '2015-10-15T13:01:00Z')}
+
+    @override_settings(EASYPOST_TRACKING_POLL_LIMIT=1)
+    def test_poll_tracking(self):
+        # the shipment which was never checked goes first
+        self.assertEqual(tasks.poll_tracking(), {'checked': 1, 'updated': 1, 'failed': 0})
+        self.assertEqual(FakeEasypost.Shipment.retrieved, ['shp_polled_1'])
+
+        shipment = Shipment.objects.get(id=self.shipments[1].id)
+        self.assertEqual(shipment.tracking_status, 'in_transit')
+        self.assertEqual(shipment.shipmenttrackinghistory_set.count(), 1)
+        self.assertIsNotNone(shipment.tracking_checked_date)
+
+        tasks.poll_tracking()
+        self.assertEqual(FakeEasypost.Shipment.retrieved, ['shp_polled_1', 'shp_polled_0'])
+        self.assertEqual(tasks.poll_tracking(), {'checked': 0, 'updated': 0, 'failed': 0})
+
+    def test_poll_tracking_failures(self):
+        shipment = Shipment.objects.create(to_address=AddressFactory.create(), from_address=AddressFactory.create(),
+                                           easypost_id='shp_polled_failing')
+        Label.objects.create(shipment=shipment)
+        FakeEasypost.Shipment.shipments['shp_polled_failing'] = ValueError('EasyPost is down')
+        FakeEasypost.Shipment.shipments['shp_polled_0']['tracker']['tracking_details'][0]['message'] = None
+
+        self.assertEqual(tasks.poll_tracking(), {'checked': 3, 'updated': 1, 'failed': 2})
+        self.assertEqual(list(Shipment.objects.order_by('easypost_id').values_list('tracking_status', flat=True)),
+                         [Shipment.Status.PRE_TRANSIT, 'in_transit', Shipment.Status.UNKNOWN])
+        # the failed shipments are retried after their interval
+        self.assertFalse(Shipment.objects.due_for_tracking().exists())
+
+    def test_webhook_updates_are_not_polled(self):
+        tasks.apply_tracker_update(FakeEasypostObject.convert(make_tracker('shp_polled_0', 'in_transit',
+                                                                           '2015-10-15T13:01:00Z')))
+        self.assertEqual(list(Shipment.objects.due_for_tracking().values_list('easypost_id', flat=True)),
+                         ['shp_polled_1'])
+
+
+class UpdateRefundStatusesTest(FakeEasypostMixin, TestCase):
+
+    def setUp(self):
+        super(UpdateRefundStatusesTest, self).setUp()
+        FakeEasypost.Shipment.shipments = {
+            'shp_refunded': {'refund_status': Shipment.RefundStatus.REFUNDED},
+            'shp_rejected': {'refund_status': Shipment.RefundStatus.REJECTED},
+            'shp_submitted': {'refund_status': Shipment.RefundStatus.SUBMITTED},
+            'shp_failed': ValueError('EasyPost is down'),
+        }
+        for easypost_id in FakeEasypost.Shipment.shipments:
+            Shipment.objects.create(to_address=AddressFactory.create(), from_address=AddressFactory.create(),
+                                    easypost_id=easypost_id, refund_status=Shipment.RefundStatus.SUBMITTED)
+
+    @override_settings(EASYPOST_REFUND_POLL_CHUNK_SIZE=3, EASYPOST_REFUND_POLL_WORKERS=2)
+    def test_update_refund_statuses(self):
+        # one query for the shipments and one update for each new status
+        with self.assertNumQueries(3):
+            counts = tasks.update_refund_statuses()
+
+        self.assertEqual(counts, {'checked': 4, 'changed': 2, 'failed': 1})
+        refund_statuses = dict(Shipment.objects.values_list('easypost_id', 'refund_status'))
+        self.assertEqual(refund_statuses, {'shp_refunded': Shipment.RefundStatus.REFUNDED,
+                                           'shp_rejected': Shipment.RefundStatus.REJECTED,
+                                           'shp_submitted': Shipment.RefundStatus.SUBMITTED,
+                                           'shp_failed': Shipment.RefundStatus.SUBMITTED})
+
+
+class ShipmentCacheTest(TestCase):
+
+    class FakeEasypostShipment(object):
+        id = 'shp_cached'
+
+    def setUp(self):
+        self.shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                from_address=AddressFactory.create(),
+                                                easypost_id=self.FakeEasypostShipment.id)
+        self.easypost_shipment = self.FakeEasypostShipment()
+        shipment_cache.set(self.easypost_shipment)
+
+    def tearDown(self):
+        shipment_cache.clear()
+
+    def test_get_easypost_shipment_from_cache(self):
+        self.assertIs(self.shipment.get_easypost_shipment(), self.easypost_shipment)
+
+    def test_delete(self):
+        shipment_cache.delete(self.shipment.easypost_id)
+        self.assertIsNone(shipment_cache.get(self.shipment.easypost_id))
+
+
 class LabelTest(TestCase):
 
     def setUp(self):
@@ -135,6 +837,10 @@ class LabelTest(TestCase):
         self.label.request_label_file()
         self.assertEqual(self.label.label_url, self.easypost_shipment.postage_label.label_url)
 
+    def test_request_label_files(self):
+        self.assertEqual(sorted(self.label.request_label_files()), sorted(Label.LABEL_FORMATS))
+        self.assertTrue(self.label.label_zpl_url)
+
 
 class EasypostWebhookCallbackTest(TestCase):
     url_name = 'easypost_webhook_callback'
@@ -212,3 +918,175 @@ class EasypostWebhookCallbackTest(TestCase):
         updated_shipment = Shipment.objects.get(id=self.shipment.id)
         self.assertEqual(updated_shipment.tracking_status, 'pre_transit')
         self.assertEqual(updated_shipment.tracking_code, '9499907123456123456781')
+
+
+class CoalesceTrackerUpdateTest(FakeEasypostMixin, TestCase):
+
+    def setUp(self):
+        super(CoalesceTrackerUpdateTest, self).setUp()
+        self.scheduled = []
+        tasks.process_coalesced_tracker_update.apply_async = lambda args, countdown: self.scheduled.append(args)
+        self.shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                                from_address=AddressFactory.create(),
+                                                easypost_id='shp_coalesced')
+
+    def tearDown(self):
+        del tasks.process_coalesced_tracker_update.apply_async
+        super(CoalesceTrackerUpdateTest, self).tearDown()
+
+    def tracker(self, status, updated_at):
+        return FakeEasypostObject.convert(make_tracker('shp_coalesced', status, updated_at))
+
+    def get_tracking_status(self):
+        return Shipment.objects.get(id=self.shipment.id).tracking_status
+
+    @override_settings(EASYPOST_TRACKER_COALESCE_WINDOW=30)
+    def test_coalesce(self):
+        tasks.coalesce_tracker_update(self.tracker('pre_transit', '2015-10-15T13:00:00Z'))
+        tasks.coalesce_tracker_update(self.tracker('in_transit', '2015-10-15T13:01:00Z'))
+        # only one run is scheduled for the window
+        self.assertEqual(self.scheduled, [['shp_coalesced']])
+        self.assertEqual(self.get_tracking_status(), Shipment.Status.UNKNOWN)
+
+        tasks.process_coalesced_tracker_update('shp_coalesced')
+        self.assertEqual(self.get_tracking_status(), 'in_transit')
+        self.assertEqual(self.shipment.shipmenttrackinghistory_set.count(), 1)
+
+        # a later update is scheduled in a new window
+        tasks.coalesce_tracker_update(self.tracker('delivered', '2015-10-16T09:00:00Z'))
+        self.assertEqual(len(self.scheduled), 2)
+
+    @override_settings(EASYPOST_TRACKER_COALESCE_WINDOW=30)
+    def test_coalesce_out_of_order(self):
+        tasks.coalesce_tracker_update(self.tracker('in_transit', '2015-10-15T13:01:00Z'))
+        tasks.coalesce_tracker_update(self.tracker('pre_transit', '2015-10-15T13:00:00Z'))
+        tasks.process_coalesced_tracker_update('shp_coalesced')
+        self.assertEqual(self.get_tracking_status(), 'in_transit')
+
+        # an older update arriving after the newer one was applied is ignored too
+        tasks.coalesce_tracker_update(self.tracker('pre_transit', '2015-10-15T13:00:00Z'))
+        tasks.process_coalesced_tracker_update('shp_coalesced')
+        self.assertEqual(self.get_tracking_status(), 'in_transit')
+        self.assertEqual(len(self.scheduled), 1)
+
+
+class WebhookEventBatchTest(FakeEasypostMixin, TestCase):
+
+    def setUp(self):
+        super(WebhookEventBatchTest, self).setUp()
+        tasks.process_webhook_event_batch.apply_async = lambda countdown: None
+        self.shipments = [Shipment.objects.create(to_address=AddressFactory.create(),
+                                                  from_address=AddressFactory.create(),
+                                                  easypost_id='shp_batched_{0}'.format(i)) for i in range(2)]
+
+    def tearDown(self):
+        del tasks.process_webhook_event_batch.apply_async
+        super(WebhookEventBatchTest, self).tearDown()
+
+    def test_process_webhook_event_batch_drops_invalid_events(self):
+        bad_detail = make_tracker('shp_batched_1', 'in_transit', '2015-10-15T13:01:00Z')
+        bad_detail['tracking_details'][0]['datetime'] = 'yesterday'
+        payloads = [
+            {'id': 'evt_0', 'description': 'tracker.updated',
+             'result': make_tracker('shp_batched_0', 'in_transit', '2015-10-15T13:01:00Z')},
+            [],
+            {'id': 'evt_no_shipment', 'description': 'tracker.updated', 'result': {'status': 'delivered'}},
+            {'id': 'evt_bad_detail', 'description': 'tracker.updated', 'result': bad_detail},
+            {'id': {'not': 'a string'}},
+            {'id': 'evt_1', 'description': 'tracker.updated',
+             'result': make_tracker('shp_batched_1', 'pre_transit', '2015-10-15T13:00:00Z')},
+        ]
+        for payload in payloads:
+            tasks.queue_webhook_event(json.dumps(payload))
+        tasks.queue_webhook_event('{')
+
+        tasks.process_webhook_event_batch()
+
+        self.assertFalse(PendingWebhookEvent.objects.exists())
+        self.assertEqual(sorted(WebhookEvent.objects.values_list('easypost_id', flat=True)),
+                         ['evt_0', 'evt_1'])
+        self.assertEqual(list(Shipment.objects.order_by('easypost_id').values_list('tracking_status', flat=True)),
+                         ['in_transit', 'pre_transit'])
+
+    def test_process_webhook_event_batch_drops_unstorable_events(self):
+        payloads = []
+        for field, value in [('message', None), ('status', None), ('status', 'in_transit' * 10)]:
+            tracker = make_tracker('shp_batched_1', 'in_transit', '2015-10-15T13:01:00Z')
+            tracker['tracking_details'][0][field] = value
+            payloads.append({'id': 'evt_{0}'.format(len(payloads)), 'description': 'tracker.updated',
+                             'result': tracker})
+        payloads.append({'id': 'evt_valid', 'description': 'tracker.updated',
+                         'result': make_tracker('shp_batched_0', 'in_transit', '2015-10-15T13:01:00Z')})
+        for payload in payloads:
+            tasks.queue_webhook_event(json.dumps(payload))
+
+        tasks.process_webhook_event_batch()
+
+        self.assertFalse(PendingWebhookEvent.objects.exists())
+        self.assertEqual(list(WebhookEvent.objects.values_list('easypost_id', flat=True)), ['evt_valid'])
+        self.assertEqual(list(Shipment.objects.order_by('easypost_id').values_list('tracking_status', flat=True)),
+                         ['in_transit', Shipment.Status.UNKNOWN])
+
+    def test_apply_valid_tracker_updates(self):
+        trackers = [FakeEasypostObject.convert(make_tracker(shipment.easypost_id, 'in_transit', '2015-10-15T13:01:00Z'))
+                    for shipment in self.shipments]
+        # not validated, storing the history fails
+        trackers[1].tracking_details[0]['message'] = None
+
+        self.assertEqual(tasks.apply_valid_tracker_updates(trackers), [trackers[1]])
+        self.assertEqual(list(Shipment.objects.order_by('easypost_id').values_list('tracking_status', flat=True)),
+                         ['in_transit', Shipment.Status.UNKNOWN])
+        self.assertEqual(ShipmentTrackingHistory.objects.count(), 1)
+
+    def test_apply_tracker_updates_bulk(self):
+        trackers = [FakeEasypostObject.convert(make_tracker(shipment.easypost_id, 'in_transit', '2015-10-15T13:01:00Z'))
+                    for shipment in self.shipments]
+        with CaptureQueriesContext(connection) as queries:
+            tasks.apply_tracker_updates(trackers)
+
+        # one UPDATE for the tracking statuses and one for the latest tracking updates, however many shipments
+        self.assertEqual(len([query for query in queries if 'UPDATE "easypost_shipment"' in query['sql']]), 2)
+        self.assertEqual(Shipment.objects.filter(tracking_status='in_transit',
+                                                 latest_tracking_status='in_transit').count(), 2)
+
+
+class WebhookEventTest(TestCase):
+    url_name = 'easypost_webhook_callback'
+
+    def test_claim(self):
+        self.assertTrue(WebhookEvent.objects.claim('evt_qatAiJDM'))
+        self.assertFalse(WebhookEvent.objects.claim('evt_qatAiJDM'))
+
+    def test_claim_many(self):
+        WebhookEvent.objects.claim('evt_1')
+        self.assertEqual(WebhookEvent.objects.claim_many(['evt_1', 'evt_2', 'evt_3', 'evt_2']), set(['evt_2', 'evt_3']))
+        self.assertEqual(WebhookEvent.objects.count(), 3)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_post_processed_event(self):
+        WebhookEvent.objects.create(easypost_id='evt_qatAiJDM')
+        shipment = Shipment.objects.create(to_address=AddressFactory.create(),
+                                           from_address=AddressFactory.create(),
+                                           easypost_id='shp_tracked')
+        data = {
+            "id": "evt_qatAiJDM",
+            "object": "Event",
+            "description": "tracker.updated",
+            "result": {
+                "object": "Tracker",
+                "tracking_code": "9499907123456123456781",
+                "status": "pre_transit",
+                "tracking_details": [],
+                "shipment_id": shipment.easypost_id
+            }
+        }
+
+        response = self.client.post(reverse(self.url_name), data=json.dumps(data), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(Shipment.objects.get(id=shipment.id).tracking_status, Shipment.Status.UNKNOWN)
+
+    def test_post_invalid_json(self):
+        response = self.client.post(reverse(self.url_name), data='{', content_type='application/json')
+        self.assertEqual(400, response.status_code)
+        response = self.client.post(reverse(self.url_name), data='[]', content_type='application/json')
+        self.assertEqual(400, response.status_code)
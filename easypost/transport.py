@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import easypost
+
+
+class EasyPostSession(requests.Session):
+    """
+    A requests Session which keeps a pool of keep-alive connections per host and applies separate
+    connect and read timeouts to every request
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, max_retries=0, connect_timeout=None, read_timeout=None):
+        super(EasyPostSession, self).__init__()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._local = threading.local()
+
+    def request(self, method, url, **kwargs):
+        if self.connect_timeout is not None or self.read_timeout is not None:
+            kwargs['timeout'] = (self.connect_timeout, self.read_timeout or kwargs.get('timeout'))
+        response = super(EasyPostSession, self).request(method, url, **kwargs)
+        if response.status_code == 429:
+            self._local.retry_after = response.headers.get('Retry-After')
+        return response
+
+    def pop_retry_after(self):
+        """
+        Returns the number of seconds from the Retry-After header of the last rate limited (429) response
+        to a request made by this thread, or None, and forgets it
+        """
+        retry_after = getattr(self._local, 'retry_after', None)
+        self._local.retry_after = None
+        try:
+            return max(float(retry_after), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+def configure_transport():
+    """
+    Install an EasyPostSession configured from the EASYPOST_HTTP_* settings as the session the easypost
+    library sends all of its requests with, so connections are reused by every call in this process
+    """
+    session = EasyPostSession(
+        pool_connections=getattr(settings, 'EASYPOST_HTTP_POOL_CONNECTIONS', 10),
+        pool_maxsize=getattr(settings, 'EASYPOST_HTTP_POOL_MAXSIZE', 10),
+        max_retries=getattr(settings, 'EASYPOST_HTTP_MAX_RETRIES', 0),
+        connect_timeout=getattr(settings, 'EASYPOST_HTTP_CONNECT_TIMEOUT', 10),
+        read_timeout=getattr(settings, 'EASYPOST_HTTP_READ_TIMEOUT', 60)
+    )
+    easypost.requests_session = session
+    return session
+
+
+def get_session():
+    """
+    Returns the pooled session used for EasyPost requests, which can also be used for fetching label files
+    """
+    session = getattr(easypost, 'requests_session', None)
+    if not isinstance(session, EasyPostSession):
+        session = configure_transport()
+    return session
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _call_logged(func, item):
+    try:
+        return item, func(item), None
+    except Exception as e:
+        logger.exception(e)
+        return item, None, e
+
+
+def concurrent_map(func, items, workers):
+    """
+    Call func with each of items on a pool of at most `workers` threads
+
+    Returns a list of (item, result, error) tuples in the same order as items, where error is the exception
+    func raised, if any. Exceptions are logged rather than raised so that one failure does not stop the rest.
+
+    func should only make EasyPost (HTTP) calls. Do any database work with the results afterwards in the
+    calling thread, otherwise every worker thread opens its own database connection.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [_call_logged(func, item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(partial(_call_logged, func), items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def concurrent_imap(func, items, workers, cleanup=None):
+    """
+    Like concurrent_map(), but yields the (item, result, error) tuples in order as they are consumed
+
+    At most `workers` calls are running or waiting to be consumed at once, so only that many results are
+    held in memory however many items there are. If the consumer stops early, e.g. because it raised, cleanup
+    is called with each result which was fetched ahead but not consumed, e.g. to close files.
+    """
+    if workers <= 1:
+        for item in items:
+            yield _call_logged(func, item)
+        return
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(_call_logged, (func, item)))
+            if len(pending) >= workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        while pending:
+            item, result, error = pending.popleft().get()
+            if cleanup is not None and error is None:
+                try:
+                    cleanup(result)
+                except Exception as e:
+                    logger.exception(e)
+        pool.close()
+        pool.join()
+
+
+def chunked(items, size):
+    """
+    Yield lists of up to `size` items from the iterable items
+    """
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def bulk_update(queryset, objs, fields, batch_size=None, condition=None, **values):
+    """
+    Save the fields of many objects in queryset with one UPDATE per batch of objects, which sets each object's own
+    values with Case/When (like QuerySet.bulk_update() in newer Django versions), and also sets the same values
+    on all of them
+
+    If condition is given, it is called with each object and returns a Q. The object's row is only changed where
+    the Q matches, e.g. to not overwrite newer values.
+
+    By default the batches are small enough to stay within SQLite's limit of 999 query parameters, pass a smaller
+    batch_size if condition adds parameters.
+    """
+    fields = [queryset.model._meta.get_field(name) for name in fields]
+    batch_size = batch_size or max(1, 900 // (2 * len(fields) + 1))
+    for batch in chunked(objs, batch_size):
+        updates = dict(values)
+        for field in fields:
+            updates[field.attname] = models.Case(
+                *[models.When(models.Q(pk=obj.pk) & condition(obj) if condition else models.Q(pk=obj.pk),
+                              then=models.Value(getattr(obj, field.attname), output_field=field))
+                  for obj in batch], default=models.F(field.attname), output_field=field)
+        queryset.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
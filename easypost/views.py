@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from django.utils import six
 from django.views.decorators.csrf import csrf_exempt
 
 import json
 
-from .tasks import process_webhook_event
+from .models import WebhookEvent
+from .tasks import process_webhook_event, queue_webhook_event
 
 
 @csrf_exempt
@@ -17,7 +20,22 @@ def easypost_webhook_callback(request):
         post_content = request.body
         # responses need to be 30 seconds or less, so rather than processing here, this just verifies that JSON could be decoded
         # and then pushes it off to an asynchronous task
-        process_webhook_event.delay(post_content)
+        try:
+            event = json.loads(post_content.decode('utf-8'))
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not isinstance(event, dict):
+            return HttpResponseBadRequest()
+
+        # EasyPost retries deliveries, acknowledge events which have already been processed without queuing them again
+        event_id = event.get('id')
+        if event_id and isinstance(event_id, six.string_types) and WebhookEvent.objects.is_processed(event_id):
+            return HttpResponse()
+
+        if getattr(settings, 'EASYPOST_WEBHOOK_BATCHING', False):
+            queue_webhook_event(post_content)
+        else:
+            process_webhook_event.delay(post_content)
         return HttpResponse()
 
     return HttpResponseNotAllowed(['POST', ])